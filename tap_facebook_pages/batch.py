@@ -0,0 +1,111 @@
+"""Bulk output of stream records as part files announced by Singer BATCH messages."""
+import gzip
+import json
+import sys
+import time as t
+from pathlib import Path
+from typing import List
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+
+def write_batch_message(stream_name: str, manifest: List[str], encoding: dict) -> None:
+    message = {"type": "BATCH", "stream": stream_name, "encoding": encoding, "manifest": manifest}
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+class BatchWriter:
+    """Write the records of one stream to gzip compressed JSONL part files.
+
+    A part is closed once ``max_bytes`` of (uncompressed) JSON have been written to it,
+    or by ``close`` at the end of the stream. ``flush`` emits one BATCH message listing
+    the parts closed since the previous flush, so it has to run before every STATE
+    message; while a part is ``pending`` a STATE would cover records not announced yet.
+    """
+
+    encoding = {"format": "jsonl", "compression": "gzip"}
+    extension = ".jsonl.gz"
+
+    def __init__(self, stream_name: str, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.stream_name = stream_name
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._prefix = "{}-{}".format(stream_name, int(t.time() * 1000))
+        self._parts = 0
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._manifest = []
+
+    def write(self, record: dict) -> None:
+        if self._file is None:
+            self._open()
+        line = json.dumps(record) + "\n"
+        self._file.write(line)
+        self._size += len(line)
+        if self._size >= self.max_bytes:
+            self._close()
+
+    @property
+    def pending(self) -> bool:
+        """Return whether records were written to a part that is still open."""
+        return self._file is not None
+
+    def close(self) -> None:
+        """Close the open part, the stream has written all of its records."""
+        self._close()
+
+    def flush(self) -> None:
+        if self._manifest:
+            write_batch_message(self.stream_name, self._manifest, self.encoding)
+            self._manifest = []
+
+    def _open(self) -> None:
+        self._parts += 1
+        self._path = self.root / "{}-{:05d}{}".format(self._prefix, self._parts, self.extension)
+        self._file = gzip.open(self._path, "wt", encoding="utf-8")
+        self._size = 0
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._manifest.append(self._path.resolve().as_uri())
+            self._file = None
+
+
+class ParquetBatchWriter(BatchWriter):
+    """Write Arrow record batches of one stream to Parquet part files, see BatchWriter.
+
+    A part is closed once ``max_bytes`` of Arrow buffers have been written to it.
+    """
+
+    encoding = {"format": "parquet", "compression": "snappy"}
+    extension = ".parquet"
+
+    def __init__(self, stream_name: str, root: str, schema, max_bytes: int = DEFAULT_MAX_BYTES):
+        import pyarrow.parquet
+        super().__init__(stream_name, root, max_bytes)
+        self._parquet = pyarrow.parquet
+        self.schema = schema
+
+    def write(self, record: dict) -> None:
+        import pyarrow as pa
+        self.write_batch(pa.RecordBatch.from_pylist([record], schema=self.schema))
+
+    def write_batch(self, batch) -> None:
+        if not batch.num_rows:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write_batch(batch)
+        self._size += batch.nbytes
+        if self._size >= self.max_bytes:
+            self._close()
+
+    def _open(self) -> None:
+        self._parts += 1
+        self._path = self.root / "{}-{:05d}{}".format(self._prefix, self._parts, self.extension)
+        self._file = self._parquet.ParquetWriter(str(self._path), self.schema, compression="snappy")
+        self._size = 0
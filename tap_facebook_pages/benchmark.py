@@ -0,0 +1,79 @@
+"""Benchmark of the per record work of the post insight streams.
+
+Compares the SDK's generic conforming and bookmark increment with the cached
+conformer and running maximum used by ``FacebookPagesStream``::
+
+    python -m tap_facebook_pages.benchmark --posts 2000 --metrics 20
+"""
+import json
+import logging
+import time as t
+
+import click
+from singer_sdk.helpers._state import increment_state
+from singer_sdk.helpers._typing import conform_record_data_types
+
+from tap_facebook_pages.conform import get_conformer, parse_timestamp
+from tap_facebook_pages.streams import SCHEMAS_DIR
+
+REPLICATION_KEY = "post_created_time"
+
+
+def generate_rows(posts: int, metrics: int, values: int):
+    """Return post insight rows as parse_rows yields them, every row of a post sharing its created_time."""
+    rows = []
+    for post in range(posts):
+        created_time = "2021-{:02d}-{:02d}T{:02d}:00:00+0000".format(post % 12 + 1, post % 28 + 1, post % 24)
+        for metric in range(metrics):
+            for value in range(values):
+                rows.append({
+                    "post_id": "1_{}".format(post), "page_id": "1", REPLICATION_KEY: created_time,
+                    "name": "post_metric_{}".format(metric), "period": "lifetime", "title": "Metric",
+                    "description": "Metric", "id": "1_{}/insights/post_metric_{}/lifetime".format(post, metric),
+                    "value": value,
+                })
+    return rows
+
+
+def run_generic(rows: list, schema: dict, logger) -> dict:
+    state = {}
+    for row in rows:
+        record = conform_record_data_types(stream_name="post_insights", row=row, schema=schema, logger=logger)
+        increment_state(state, replication_key=REPLICATION_KEY, latest_record=record, is_sorted=False)
+    return state
+
+
+def run_fast(rows: list, schema: dict, logger) -> dict:
+    state = {}
+    conform = get_conformer("post_insights", schema, logger)
+    for row in rows:
+        record = conform(row)
+        bookmark = state.get("progress_markers", {}).get("replication_key_value")
+        if bookmark is not None and parse_timestamp(record[REPLICATION_KEY]) <= parse_timestamp(bookmark):
+            continue
+        increment_state(state, replication_key=REPLICATION_KEY, latest_record=record, is_sorted=False)
+    return state
+
+
+@click.command(help="Time the per record conforming and bookmark tracking of a post insight stream.")
+@click.option("--posts", type=int, default=2000, show_default=True)
+@click.option("--metrics", type=int, default=20, show_default=True)
+@click.option("--values", type=int, default=1, show_default=True, help="Values per metric.")
+def benchmark_cli(posts, metrics, values):
+    with open(SCHEMAS_DIR / "post_insights.json") as f:
+        schema = json.load(f)
+    logger = logging.getLogger("tap-facebook-pages")
+    rows = generate_rows(posts, metrics, values)
+    results = {"rows": len(rows)}
+    for name, run in (("generic", run_generic), ("fast", run_fast)):
+        parse_timestamp.cache_clear()
+        started = t.perf_counter()
+        state = run([dict(x) for x in rows], schema, logger)
+        results[name + "_seconds"] = round(t.perf_counter() - started, 3)
+        results[name + "_bookmark"] = state["progress_markers"]["replication_key_value"]
+    results["speedup"] = round(results["generic_seconds"] / max(results["fast_seconds"], 1e-9), 1)
+    click.echo(json.dumps(results))
+
+
+if __name__ == "__main__":
+    benchmark_cli()
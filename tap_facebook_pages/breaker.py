@@ -0,0 +1,46 @@
+"""Run-wide circuit breaker for pages the access tokens are not authorized for."""
+import threading
+
+ALL_SCOPES = "*"
+
+
+class AuthorizationBreaker:
+    """Remember the (page_id, permission scope) pairs that failed authorization.
+
+    Once a pair is open every stream sharing the scope skips the page straight away,
+    instead of repeating a request that is bound to fail.
+    """
+
+    def __init__(self):
+        self._failures = {}
+        self._skipped = {}
+        self._lock = threading.Lock()
+
+    def trip(self, page_id: str, scope: str, stream_name: str, reason: str) -> None:
+        with self._lock:
+            self._failures.setdefault((page_id, scope), (stream_name, reason))
+
+    def is_open(self, page_id: str, scope: str) -> bool:
+        return (page_id, scope) in self._failures or (page_id, ALL_SCOPES) in self._failures
+
+    def skip(self, page_id: str, scope: str) -> None:
+        key = (page_id, scope) if (page_id, scope) in self._failures else (page_id, ALL_SCOPES)
+        with self._lock:
+            self._skipped[key] = self._skipped.get(key, 0) + 1
+
+    def reset(self) -> set:
+        """Forget all failures, returning the ids of the pages that had one."""
+        with self._lock:
+            pages = {page_id for page_id, _ in self._failures}
+            self._failures = {}
+            self._skipped = {}
+        return pages
+
+    def report(self, logger) -> None:
+        """Log one summary line per page and scope that failed authorization."""
+        if not self._failures:
+            return
+        logger.warning("Authorization failed for {} page scope(s):".format(len(self._failures)))
+        for (page_id, scope), (stream_name, reason) in sorted(self._failures.items()):
+            logger.warning("  page {} scope '{}': first failed in {} ({}), skipped {} more stream partition(s)".format(
+                page_id, scope, stream_name, reason, self._skipped.get((page_id, scope), 0)))
@@ -0,0 +1,45 @@
+"""Reading of Page webhook payloads for the change feed sync mode."""
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger("tap-facebook-pages")
+
+# feed items that are posts themselves, removing one of them leaves nothing to fetch
+POST_ITEMS = ("post", "status", "photo", "video", "share", "link")
+
+
+def read_change_feed(path: str) -> Dict[str, List[str]]:
+    """Return the ids of the posts mentioned by ``feed`` changes, per page id.
+
+    ``path`` is a newline-delimited file of webhook payloads or a directory of such
+    files. Comments and reactions name the post they belong to, so its insights are
+    picked up again; removed posts are left out.
+    """
+    path = Path(path)
+    files = sorted(x for x in path.iterdir() if x.is_file()) if path.is_dir() else [path]
+    post_ids = {}
+    for file in files:
+        with open(file) as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    payload = json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping invalid change feed line %s:%s", file, number)
+                    continue
+                for entry in payload.get("entry", []):
+                    for change in entry.get("changes", []):
+                        value = change.get("value", {})
+                        if change.get("field") != "feed" or "post_id" not in value:
+                            continue
+                        page_posts = post_ids.setdefault(str(entry["id"]), {})
+                        if value.get("verb") == "remove" and value.get("item") in POST_ITEMS:
+                            # the post is gone, also forget the earlier changes mentioning it
+                            page_posts.pop(value["post_id"], None)
+                            continue
+                        # a dict keeps the ids unique and in feed order
+                        page_posts[value["post_id"]] = None
+    return {page_id: list(ids) for page_id, ids in post_ids.items()}
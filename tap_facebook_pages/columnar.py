@@ -0,0 +1,74 @@
+"""Columnar (Arrow) decoding of insight responses, an optional path needing pyarrow."""
+from typing import Iterable, Iterator, Tuple
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# repeated for every value of a metric, stored once per batch
+DICTIONARY_COLUMNS = ("name", "period", "title", "description", "id", "page_id", "post_id", "post_created_time",
+                      "snapshot_time")
+# set per value rather than per metric
+VALUE_COLUMNS = ("context", "value", "end_time")
+RECORD_CHUNK = 1000  # rows converted to records at a time
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("The columnar_insights option needs pyarrow, install it with `pip install pyarrow`")
+
+
+def _arrow_type(name: str, property_schema: dict):
+    types = property_schema.get("type", [])
+    types = types if isinstance(types, list) else [types]
+    if name in DICTIONARY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if "integer" in types:
+        return pa.int64()
+    if "number" in types:
+        return pa.float64()
+    return pa.string()
+
+
+def arrow_schema(schema: dict, deselected: Iterable[str] = ()):
+    """Return the Arrow schema of a stream's selected properties, repeated strings dictionary encoded."""
+    require_pyarrow()
+    return pa.schema([pa.field(x, _arrow_type(x, y)) for x, y in schema["properties"].items() if x not in deselected])
+
+
+def insight_batch(metrics: Iterable[Tuple[dict, dict]], schema) -> "pa.RecordBatch":
+    """Decode insight metrics into one record batch without a dict per value.
+
+    ``metrics`` yields (base item, insight object) pairs: the columns shared by all values
+    of the metric and the API's metric object with its ``values``. Dict values are split
+    into one row per key, the key going to ``context``, as the record path does.
+    """
+    columns = {x: [] for x in schema.names}
+    base_columns = [(x, columns[x]) for x in schema.names if x not in VALUE_COLUMNS]
+    contexts, values, end_times = (columns.get(x, []) for x in VALUE_COLUMNS)
+    for base, insight in metrics:
+        for entry in insight.get("values", []):
+            value, end_time = entry.get("value"), entry.get("end_time")
+            pairs = value.items() if isinstance(value, dict) else ((None, value),)
+            for context, item in pairs:
+                for name, column in base_columns:
+                    column.append(base.get(name))
+                contexts.append(context)
+                values.append(item)
+                end_times.append(end_time)
+
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns[field.name], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_records(batch) -> Iterator[dict]:
+    """Convert a record batch to records lazily, a chunk at a time."""
+    for offset in range(0, batch.num_rows, RECORD_CHUNK):
+        for record in batch.slice(offset, RECORD_CHUNK).to_pylist():
+            yield {x: y for x, y in record.items() if y is not None}
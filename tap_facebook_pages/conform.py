@@ -0,0 +1,74 @@
+"""Cached record conformers and bookmark parsing for high volume streams."""
+import functools
+import json
+import threading
+from typing import Callable, Dict, Optional
+
+import pendulum
+from singer_sdk.helpers._catalog import pop_deselected_record_properties
+from singer_sdk.helpers._singer import SelectionMask
+from singer_sdk.helpers._typing import conform_record_data_types
+
+_conformers = {}
+_lock = threading.Lock()
+# types of JSON decoded values, others are conformed by the SDK
+JSON_TYPES = (str, int, float, bool, type(None), list, dict)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_timestamp(value: str):
+    """Parse a replication key value once, the rows of a post all share its created_time."""
+    return pendulum.parse(value)
+
+
+def _is_boolean(property_schema: dict) -> bool:
+    types = property_schema.get("type", [])
+    types = types if isinstance(types, list) else [types]
+    types += [x.get("type") for x in property_schema.get("anyOf", [])]
+    return "boolean" in types
+
+
+def get_conformer(stream_name: str, schema: dict, logger,
+                  mask: Optional[SelectionMask] = None) -> Callable[[dict], dict]:
+    """Return a function conforming JSON decoded rows to ``schema``, built once per schema and selection.
+
+    It does what the SDK's removal of deselected properties and its generic conforming
+    do: drop the properties deselected in ``mask`` (nested ones included) and those
+    missing from the schema (warning once per stream), and turn the values of boolean
+    properties into booleans. Only JSON values are checked on the fast path, others take
+    the SDK's conforming.
+    """
+    mask = mask if mask is not None else SelectionMask()
+    key = (json.dumps(schema, sort_keys=True), frozenset(mask.items()))
+    with _lock:
+        if key in _conformers:
+            properties, deselected, nested, booleans = _conformers[key]
+        else:
+            names = schema.get("properties", {})
+            deselected = frozenset(x for x in names if not mask[("properties", x)])
+            properties = frozenset(names) - deselected
+            # properties with deselected sub-properties
+            nested = frozenset(x[1] for x, y in mask.items() if len(x) > 2 and not y) & properties
+            booleans = frozenset(x for x, y in names.items() if _is_boolean(y))
+            _conformers[key] = properties, deselected, nested, booleans
+    warned = set()
+
+    def conform(row: Dict) -> Dict:
+        record = {}
+        for name, value in row.items():
+            if name not in properties:
+                if name not in warned and name not in deselected:
+                    warned.add(name)
+                    logger.warning("Property '{}' was present in the '{}' stream but not found in catalog schema. "
+                                   "Ignoring.".format(name, stream_name))
+                continue
+            if type(value) not in JSON_TYPES:
+                value = conform_record_data_types(stream_name, {name: value}, schema, logger)[name]
+            elif name in booleans:
+                value = None if value is None else value != 0
+            elif name in nested and isinstance(value, dict):
+                pop_deselected_record_properties(value, schema, mask, logger, ("properties", name))
+            record[name] = value
+        return record
+
+    return conform
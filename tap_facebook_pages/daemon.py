@@ -0,0 +1,109 @@
+"""Long-running daemon mode: incremental syncs on a schedule from one resident tap."""
+import contextlib
+import datetime
+import json
+import os
+import signal
+import threading
+import time as t
+from pathlib import Path
+
+import click
+
+DEFAULT_INTERVAL = 3600  # seconds between syncs
+DEFAULT_KEEP = 48  # output files kept
+OUTPUT_PREFIX = "tap-output-"
+STATE_FILE = "state.json"
+
+
+def write_state(path: Path, state: dict) -> None:
+    """Replace the state file atomically, so a reader never sees half of it."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(str(tmp_path), str(path))
+
+
+def rotate_outputs(output_dir: Path, keep: int) -> None:
+    """Delete all but the ``keep`` newest output files."""
+    outputs = sorted(output_dir.glob(OUTPUT_PREFIX + "*.jsonl"))
+    for path in outputs[:max(0, len(outputs) - keep)]:
+        path.unlink()
+
+
+class Daemon:
+    """Run incremental syncs of one tap instance every ``interval`` seconds or on SIGUSR1.
+
+    The tap, its page tokens, HTTP sessions, parsed schemas and learned bounds (earliest
+    activity, page sizes, invalid metrics) stay in memory between syncs. Every sync
+    writes its messages to a new file in ``output_dir`` and the resulting state to
+    ``state.json`` next to them. SIGTERM and SIGINT stop the daemon after the current sync.
+    """
+
+    def __init__(self, tap, output_dir: str, interval: float = DEFAULT_INTERVAL, keep: int = DEFAULT_KEEP):
+        self.tap = tap
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self.keep = keep
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def install_signal_handlers(self) -> None:
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: self._wake.set())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stop())
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wake.set()
+
+    def run_cycle(self) -> Path:
+        """Sync once into a new output file and save the state, returning the output path."""
+        # microseconds keep cycles triggered within a second apart, "x" never overwrites an output
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        output_path = self.output_dir / "{}{}.jsonl".format(OUTPUT_PREFIX, stamp)
+        self.tap.reset_run()
+        self.tap.logger.info("Starting sync into {}".format(output_path))
+        started = t.time()
+        with open(output_path, "x") as output, contextlib.redirect_stdout(output):
+            self.tap.sync_all()
+        write_state(self.output_dir / STATE_FILE, self.tap.state)
+        rotate_outputs(self.output_dir, self.keep)
+        self.tap.logger.info("Sync finished in {} seconds".format(int(t.time() - started)))
+        return output_path
+
+    def run(self, max_cycles: int = None) -> None:
+        cycles = 0
+        while not self._stopping and (max_cycles is None or cycles < max_cycles):
+            self._wake.clear()
+            try:
+                self.run_cycle()
+            except Exception as e:
+                # the next cycle resumes from the state kept in memory
+                self.tap.logger.exception("Sync failed: {}".format(e))
+            cycles += 1
+            if not self._stopping and (max_cycles is None or cycles < max_cycles):
+                self._wake.wait(self.interval)
+
+
+@click.command(help="Keep the tap resident and run an incremental sync every interval or on SIGUSR1.")
+@click.option("--config", multiple=True, required=True, help="Configuration file location.")
+@click.option("--catalog", help="Catalog file location.")
+@click.option("--state", help="Initial state file location, defaults to the state saved in --output-dir.")
+@click.option("--output-dir", required=True, help="Directory of the rotated output files and state.json.")
+@click.option("--interval", type=float, default=DEFAULT_INTERVAL, show_default=True,
+              help="Seconds between the end of a sync and the start of the next one.")
+@click.option("--keep", type=int, default=DEFAULT_KEEP, show_default=True, help="Output files to keep.")
+@click.option("--max-cycles", type=int, help="Stop after this many syncs.")
+def daemon_cli(config, catalog, state, output_dir, interval, keep, max_cycles):
+    from tap_facebook_pages.tap import TapFacebookPages
+
+    saved_state = Path(output_dir) / STATE_FILE
+    if not state and saved_state.exists():
+        state = str(saved_state)
+    daemon = Daemon(TapFacebookPages(config=list(config), catalog=catalog, state=state),
+                    output_dir, interval=interval, keep=keep)
+    daemon.install_signal_handlers()
+    daemon.run(max_cycles=max_cycles)
@@ -0,0 +1,110 @@
+"""Hedged GET requests, cutting the tail latency of slow Graph API calls."""
+import collections
+import contextlib
+import threading
+import time as t
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+
+import requests
+
+DEFAULT_BUDGET = 0.05  # hedges per request sent
+MIN_WORKERS = 8
+MIN_SAMPLES = 20  # latencies a stream needs before its requests are hedged
+MAX_SAMPLES = 200
+
+
+class Hedger:
+    """Send a duplicate of a GET that runs past a latency percentile of its stream.
+
+    Whichever of the two answers first is used, the other one is left to finish in
+    the background. Hedges are limited to ``budget`` times the requests sent, so a
+    slow API does not double the quota spent. ``streams`` is the number of streams
+    sending at the same time: each may have a request and its hedge in the pool, so
+    a request never waits for a free worker while its delay runs.
+    """
+
+    def __init__(self, percentile: float, budget: float = DEFAULT_BUDGET, streams: int = 1):
+        self.percentile = percentile
+        self.budget = budget
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=MAX_SAMPLES))
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(MIN_WORKERS, 2 * streams),
+                                        thread_name_prefix="hedge")
+
+    def delay(self, key: str) -> Optional[float]:
+        """Return the latency percentile of the key, None while too few requests were seen."""
+        latencies = sorted(self._latencies[key])
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _timed_send(self, session: requests.Session, prepared_request: requests.PreparedRequest):
+        started = t.perf_counter()
+        response = session.send(prepared_request)
+        return response, t.perf_counter() - started
+
+    def _budgeted_send(self, request_budget, session: requests.Session,
+                       prepared_request: requests.PreparedRequest):
+        with request_budget:
+            return self._timed_send(session, prepared_request)
+
+    def send(self, key: str, session: requests.Session, prepared_request: requests.PreparedRequest,
+             request_budget=contextlib.suppress()) -> requests.Response:
+        """Send a request, hedging it if it runs late.
+
+        The caller holds ``request_budget`` for the request, the hedge takes a slot of
+        its own before it is sent.
+        """
+        with self._lock:
+            self.requests += 1
+        delay = self.delay(key) if prepared_request.method == "GET" else None
+        if delay is None:
+            response, latency = self._timed_send(session, prepared_request)
+            self._latencies[key].append(latency)
+            return response
+
+        primary = self._pool.submit(self._timed_send, session, prepared_request)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            response, latency = primary.result()
+            self._latencies[key].append(latency)
+            return response
+
+        hedge = self._pool.submit(self._budgeted_send, request_budget, session, prepared_request.copy())
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [x for x in done if x.exception() is None]
+            if not succeeded and pending:
+                continue  # the other request may still succeed
+            future = (succeeded or list(done))[0]
+            if future is hedge and succeeded:
+                with self._lock:
+                    self.wins += 1
+            response, latency = future.result()
+            # the hedge only started after the delay
+            self._latencies[key].append(latency + (delay if future is hedge else 0))
+            return response
+
+    def reset(self) -> None:
+        """Start counting requests and hedges anew, the learned latencies are kept."""
+        with self._lock:
+            self.requests = 0
+            self.hedges = 0
+            self.wins = 0
+
+    def report(self, logger) -> None:
+        if self.hedges:
+            logger.info("Hedged {} of {} requests, {} hedge(s) answered first".format(
+                self.hedges, self.requests, self.wins))
@@ -0,0 +1,42 @@
+"""Persistent cache of insight metrics the Graph API rejects."""
+import json
+import os
+import threading
+from typing import Iterable, List, Optional
+
+
+class InvalidMetricCache:
+    """Remember invalid or deprecated metrics per API version and page.
+
+    A metric may be rejected for one page only, e.g. a video metric of a page without
+    videos, so metrics are cached for the page that rejected them. With a ``path`` the
+    cache is a JSON file ``{"<api version>": {"<page id>": [metric, ...]}}`` shared by
+    later runs, without one it only lives for the current run.
+    """
+
+    def __init__(self, path: Optional[str], api_version: str):
+        self.path = path
+        self.api_version = api_version
+        self._cache = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._cache = json.load(f)
+        if not isinstance(self._cache.get(api_version, {}), dict):
+            # a cache of the version as a whole, written before metrics were cached per page
+            self._cache[api_version] = {}
+
+    def metrics(self, page_id: str) -> set:
+        return set(self._cache.get(self.api_version, {}).get(page_id, []))
+
+    def filter(self, metrics: Iterable[str], page_id: str) -> List[str]:
+        invalid = self.metrics(page_id)
+        return [x for x in metrics if x not in invalid]
+
+    def add(self, metrics: Iterable[str], page_id: str) -> None:
+        with self._lock:
+            pages = self._cache.setdefault(self.api_version, {})
+            pages[page_id] = sorted(self.metrics(page_id).union(metrics))
+            if self.path:
+                with open(self.path, "w") as f:
+                    json.dump(self._cache, f, indent=2)
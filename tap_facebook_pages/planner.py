@@ -0,0 +1,103 @@
+"""Offline request planner for tap-facebook-pages.
+
+Lists the request windows a sync would issue for the given config, catalog and state,
+and estimates the Graph API calls and time they cost. No request is sent.
+"""
+import json
+import math
+import time as t
+from typing import Iterator, Tuple
+
+import click
+
+from tap_facebook_pages.streams import ACTIVITY_KEY, CHECKPOINT_KEY, MIN_PROBE_WINDOWS, WINDOW_SIZE
+
+DAY = 86400
+DEFAULT_RATE_LIMIT = 200  # calls per hour
+
+
+def iter_windows(since: int, now: int) -> Iterator[Tuple[int, int]]:
+    """Yield the since/until windows a stream walks, mirroring get_window_params and paginate."""
+    until = since + WINDOW_SIZE
+    if until > now + DAY:
+        until = now
+    yield since, until
+    while True:
+        since = until
+        until = since + WINDOW_SIZE
+        if until >= now:
+            until = now
+            if until - since <= DAY:
+                return
+        yield since, until
+
+
+def plan_partition(stream, partition: dict, now: int, pages_per_window: float, probed: set) -> dict:
+    """Return the windows and the estimated number of calls of one stream partition."""
+    plan = {"stream": stream.name, "page_id": partition["page_id"], "windows": [], "probes": 0}
+    if not stream.windowed:
+        plan["requests"] = 1
+        return plan
+
+    state = stream.get_stream_or_partition_state(partition)
+    since = int(stream.get_starting_timestamp(partition).timestamp())
+    if state.get(CHECKPOINT_KEY):
+        since = state[CHECKPOINT_KEY]["since"]
+    elif state.get(ACTIVITY_KEY):
+        since = max(since, state[ACTIVITY_KEY])
+    elif stream.probe_activity and not state.get("replication_key_value"):
+        windows = -(-(now - since) // WINDOW_SIZE)
+        key = (partition["page_id"], stream.path)
+        if windows > MIN_PROBE_WINDOWS and key not in probed:
+            probed.add(key)
+            plan["probes"] = int(math.ceil(math.log2(windows))) + 1
+
+    plan["windows"] = list(iter_windows(since, now))
+    # only the post edges page inside a window, insights return every metric in one call
+    per_window = pages_per_window if stream.probe_activity else 1
+    plan["requests"] = plan["probes"] + int(math.ceil(len(plan["windows"]) * per_window))
+    return plan
+
+
+def plan_sync(tap, pages_per_window: float = 1.0, rate_limit: float = DEFAULT_RATE_LIMIT,
+              now: int = None) -> Iterator[dict]:
+    """Yield one plan per selected stream and page, followed by a summary."""
+    now = now or int(t.time())
+    streams = list(tap.streams.values())  # discovery also builds tap.partitions
+    page_count = len(tap.partitions)
+    token_requests = 1 + int(math.ceil(page_count / 100)) if page_count > 1 else page_count
+    total = token_requests
+    by_stream = {}
+    probed = set()
+    for stream in streams:
+        for partition in stream.partitions or []:  # attachment_media has no partitions
+            plan = plan_partition(stream, partition, now, pages_per_window, probed)
+            total += plan["requests"]
+            by_stream[stream.name] = by_stream.get(stream.name, 0) + plan["requests"]
+            yield plan
+
+    yield {
+        "summary": True,
+        "pages": page_count,
+        "token_requests": token_requests,
+        "requests_by_stream": by_stream,
+        "total_requests": total,
+        "rate_limit_per_hour": rate_limit,
+        "estimated_seconds": int(math.ceil(total / rate_limit * 3600)),
+    }
+
+
+@click.command(help="Print the requests a sync would issue, without calling the API.")
+@click.option("--config", multiple=True, required=True, help="Configuration file location.")
+@click.option("--catalog", help="Catalog file location.")
+@click.option("--state", help="State file location.")
+@click.option("--rate-limit", type=float, default=DEFAULT_RATE_LIMIT, show_default=True,
+              help="Graph API calls allowed per hour.")
+@click.option("--pages-per-window", type=float, default=1.0, show_default=True,
+              help="Expected result pages per window of the post edges.")
+def plan_cli(config, catalog, state, rate_limit, pages_per_window):
+    from tap_facebook_pages.tap import TapFacebookPages
+
+    tap = TapFacebookPages(config=list(config), catalog=catalog, state=state)
+    for plan in plan_sync(tap, pages_per_window=pages_per_window, rate_limit=rate_limit):
+        click.echo(json.dumps(plan))
@@ -0,0 +1,284 @@
+"""Synthetic scale harness for tap-facebook-pages.
+
+Serves N pages x M posts x K metrics from a local Graph API stand-in, runs
+``TapFacebookPages`` against it for a growing number of pages and reports wall time,
+peak memory, requests and state size per run, so super-linear behaviour shows up
+before a large page list reaches production.
+"""
+import contextlib
+import datetime
+import io
+import json
+import re
+import threading
+import time as t
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Iterator, List
+
+import click
+
+from tap_facebook_pages.streams import API_VERSION
+
+DAY = 86400
+DEFAULT_STREAMS = ("page", "posts", "post_attachments", "post_insight_impressions", "page_insight_engagement")
+GRAPH_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S+0000"
+
+
+def _graph_time(timestamp: int) -> str:
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(GRAPH_TIME_FORMAT)
+
+
+class FakeGraph:
+    """Answer the Graph API requests of the tap with generated pages, posts and insights.
+
+    Posts are spread evenly between ``since`` and now, every requested metric gets one
+    value per day (page insights) or a single lifetime value (post insights).
+    """
+
+    def __init__(self, pages: int, posts: int, since: int, now: int = None):
+        self.page_ids = [str(10 ** 14 + x) for x in range(pages)]
+        self.posts = posts
+        self.since = since
+        self.now = now or int(t.time())
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def start(self) -> "FakeGraph":
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with graph._lock:
+                    graph.requests += 1
+                url = urllib.parse.urlparse(self.path)
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+                status, body = graph.respond(url.path.strip("/").split("/"), params)
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, parts: List[str], params: dict):
+        if parts and parts[0] == API_VERSION:
+            parts = parts[1:]
+        if parts == ["me"]:
+            return 200, {"id": "user", "name": "Scale Test"}
+        if len(parts) == 2 and parts[1] == "accounts":
+            return 200, self.accounts(params)
+        if not parts or not parts[0]:
+            ids = params.get("ids", "").split(",")
+            return 200, {x: self.post(*x.split("_"), fields=params.get("fields", "")) for x in ids if "_" in x}
+        page_id = parts[0]
+        if page_id not in self.page_ids:
+            return 404, {"error": {"message": "Unknown page {}".format(page_id), "code": 100}}
+        if len(parts) == 1:
+            return 200, {"id": page_id, "name": "Page {}".format(page_id), "access_token": "token-" + page_id}
+        if parts[1] in ("posts", "published_posts"):
+            return 200, self.edge(page_id, params)
+        if parts[1] == "insights":
+            return 200, self.page_insights(page_id, params)
+        return 404, {"error": {"message": "Unknown edge {}".format(parts[1]), "code": 100}}
+
+    def accounts(self, params: dict) -> dict:
+        offset = int(params.get("after") or 0)
+        limit = int(params.get("limit", 100))
+        data = [{"id": x, "name": "Page " + x, "access_token": "token-" + x}
+                for x in self.page_ids[offset:offset + limit]]
+        response = {"data": data, "paging": {}}
+        if offset + limit < len(self.page_ids):
+            response["paging"]["cursors"] = {"after": str(offset + limit)}
+        return response
+
+    def post_time(self, index: int) -> int:
+        return self.since + (index + 1) * (self.now - self.since) // (self.posts + 1)
+
+    def post(self, page_id: str, index: str, fields: str) -> dict:
+        created_time = self.post_time(int(index))
+        post = {"id": "{}_{}".format(page_id, index), "created_time": _graph_time(created_time),
+                "message": "Post {} of page {}".format(index, page_id)}
+        if "to" in fields:
+            post["to"] = {"data": [{"id": "profile-{}".format(index), "name": "Profile {}".format(index)}]}
+        if "attachments" in fields:
+            post["attachments"] = {"data": [{
+                "type": "photo",
+                "url": "https://example.com/{}/{}".format(page_id, index),
+                "media": {"image": {"height": 720, "width": 1280, "src": "https://example.com/image.jpg"}},
+                "target": {"id": "target-{}".format(index), "url": "https://example.com/target"},
+            }]}
+        metrics = re.search(r"insights\.metric\(([^)]*)\)", fields)
+        if metrics:
+            post["insights"] = {"data": [{
+                "name": x, "period": "lifetime", "title": x, "description": x,
+                "id": "{}/insights/{}/lifetime".format(post["id"], x),
+                "values": [{"value": int(index) + position}],
+            } for position, x in enumerate(metrics.group(1).split(",")) if x]}
+        return post
+
+    def edge(self, page_id: str, params: dict) -> dict:
+        since = int(params.get("since", self.since))
+        until = int(params.get("until", self.now))
+        limit = int(params.get("limit", 100))
+        offset = int(params.get("after") or 0)
+        indexes = [x for x in range(self.posts) if since <= self.post_time(x) < until]
+        selected = indexes[offset:offset + limit]
+        response = {"data": [self.post(page_id, str(x), params.get("fields", "")) for x in selected], "paging": {}}
+        if offset + limit < len(indexes):
+            response["paging"] = {"cursors": {"after": str(offset + limit)}, "next": "{}?after={}".format(
+                page_id, offset + limit)}
+        return response
+
+    def page_insights(self, page_id: str, params: dict) -> dict:
+        since = int(params.get("since", self.since))
+        until = min(int(params.get("until", self.now)), self.now)
+        days = range(since + DAY, until + 1, DAY)
+        period = params.get("period", "day")
+        return {"data": [{
+            "name": x, "period": period, "title": x, "description": x,
+            "id": "{}/insights/{}/{}".format(page_id, x, period),
+            "values": [{"value": position, "end_time": _graph_time(day)} for day in days],
+        } for position, x in enumerate(params.get("metric", "").split(",")) if x]}
+
+
+def generate_config(graph: FakeGraph, **options) -> dict:
+    """Return a tap config syncing every page of the fake Graph API."""
+    config = {
+        "access_token": "user-token",
+        "page_ids": list(graph.page_ids),
+        "start_date": _graph_time(graph.since),
+        "graph_url": graph.url,
+    }
+    config.update(options)
+    return config
+
+
+def generate_catalog(tap, streams: List[str]) -> dict:
+    """Return the discovered catalog of the tap with only the given streams selected."""
+    catalog = json.loads(tap.catalog_json_text)
+    catalog["streams"] = [x for x in catalog["streams"] if x["tap_stream_id"] in streams]
+    for stream in catalog["streams"]:
+        for entry in stream["metadata"]:
+            if not entry["breadcrumb"]:
+                entry["metadata"]["selected"] = True
+    return catalog
+
+
+def run_once(pages: int, posts: int, metrics: int, streams: List[str], days: int,
+             trace_memory: bool = True, **options) -> dict:
+    """Sync ``pages`` generated pages once from an empty state and return the measurements."""
+    from tap_facebook_pages.tap import TapFacebookPages
+
+    now = int(t.time())
+    graph = FakeGraph(pages, posts, since=now - days * DAY, now=now).start()
+    try:
+        config = generate_config(graph, **options)
+        catalog = generate_catalog(TapFacebookPages(config=config), streams)
+        tap = TapFacebookPages(config=config, catalog=catalog, state={})
+        for stream in tap.streams.values():
+            if stream.metrics:
+                stream.metrics = stream.metrics[:metrics]
+
+        output = io.StringIO()
+        if trace_memory:
+            tracemalloc.start()
+        started = t.perf_counter()
+        with contextlib.redirect_stdout(output):
+            tap.sync_all()
+        elapsed = t.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    finally:
+        graph.stop()
+
+    records, state = 0, "{}"
+    for line in output.getvalue().splitlines():
+        if line.startswith('{"type": "RECORD"'):
+            records += 1
+        elif line.startswith('{"type": "STATE"'):
+            state = json.dumps(json.loads(line)["value"])
+    return {
+        "pages": pages,
+        "posts": posts,
+        "metrics": metrics,
+        "seconds": round(elapsed, 3),
+        "peak_memory_bytes": peak,
+        "requests": graph.requests,
+        "records": records,
+        "state_bytes": len(state),
+    }
+
+
+def run_scale(page_counts: List[int], posts: int, metrics: int, streams: List[str], days: int,
+              trace_memory: bool = True, **options) -> Iterator[dict]:
+    for pages in page_counts:
+        yield run_once(pages, posts, metrics, streams, days, trace_memory, **options)
+
+
+def plot_results(results: List[dict], path: str) -> None:
+    """Plot the measurements against the number of pages, needs matplotlib."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    keys = [("seconds", "wall time (s)"), ("peak_memory_bytes", "peak memory (bytes)"),
+            ("requests", "requests"), ("state_bytes", "state size (bytes)")]
+    figure, axes = plt.subplots(1, len(keys), figsize=(5 * len(keys), 4))
+    pages = [x["pages"] for x in results]
+    for axis, (key, label) in zip(axes, keys):
+        axis.plot(pages, [x[key] or 0 for x in results], marker="o")
+        axis.set_xlabel("pages")
+        axis.set_title(label)
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+@click.command(help="Sync generated pages from a local Graph API stand-in and report how the tap scales.")
+@click.option("--pages", default="100,500,1000,5000", show_default=True,
+              help="Comma separated page counts, one run each.")
+@click.option("--posts", type=int, default=20, show_default=True, help="Posts per page.")
+@click.option("--metrics", type=int, default=5, show_default=True, help="Metrics per insight stream.")
+@click.option("--days", type=int, default=365, show_default=True, help="Days of history from start_date.")
+@click.option("--streams", default=",".join(DEFAULT_STREAMS), show_default=True,
+              help="Comma separated streams to select.")
+@click.option("--config", "extra_config", help="JSON file of extra tap config, e.g. max_parallel_streams.")
+@click.option("--no-memory", is_flag=True, help="Skip tracemalloc, which slows the sync down.")
+@click.option("--plot", help="Write a PNG plot of the results to this path, needs matplotlib.")
+def scale_cli(pages, posts, metrics, days, streams, extra_config, no_memory, plot):
+    options = {}
+    if extra_config:
+        with open(extra_config) as f:
+            options = json.load(f)
+    results = []
+    for result in run_scale([int(x) for x in pages.split(",")], posts, metrics, streams.split(","), days,
+                            trace_memory=not no_memory, **options):
+        click.echo(json.dumps(result))
+        results.append(result)
+    if plot:
+        try:
+            plot_results(results, plot)
+        except ImportError:
+            raise click.ClickException("--plot needs matplotlib, install it with `pip install matplotlib`")
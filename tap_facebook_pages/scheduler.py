@@ -0,0 +1,46 @@
+"""Fair, priority-aware order of the page partitions of a stream."""
+import collections
+from typing import Iterable, Optional
+
+
+class PageScheduler:
+    """Interleave page partitions in turns of a few time windows each.
+
+    Pages with a higher priority go first, pages of the same priority take turns of
+    ``weight`` windows. A page that has used up ``time_budget`` seconds continues in
+    the background, once every other page is done.
+    """
+
+    def __init__(self, partitions: Iterable[dict], priorities: Optional[dict] = None,
+                 weights: Optional[dict] = None, time_budget: Optional[float] = None):
+        self.priorities = priorities or {}
+        self.weights = weights or {}
+        self.time_budget = time_budget
+        self._queues = collections.defaultdict(collections.deque)
+        self._background = collections.deque()
+        self._used = {}
+        for partition in partitions:
+            self._queues[self.priority(partition)].append(partition)
+
+    def priority(self, partition: dict) -> float:
+        return self.priorities.get(partition["page_id"], 0)
+
+    def weight(self, partition: dict) -> int:
+        """Return the number of windows the page syncs per turn."""
+        return max(1, int(self.weights.get(partition["page_id"], 1)))
+
+    def next(self) -> Optional[dict]:
+        """Return the partition whose turn is next, None once all are done."""
+        for priority in sorted(self._queues, reverse=True):
+            if self._queues[priority]:
+                return self._queues[priority].popleft()
+        return self._background.popleft() if self._background else None
+
+    def requeue(self, partition: dict, elapsed: float) -> None:
+        """Queue a partition that has windows left, after it spent ``elapsed`` seconds on its turn."""
+        page_id = partition["page_id"]
+        self._used[page_id] = self._used.get(page_id, 0) + elapsed
+        if self.time_budget is not None and self._used[page_id] >= self.time_budget:
+            self._background.append(partition)
+        else:
+            self._queues[self.priority(partition)].append(partition)
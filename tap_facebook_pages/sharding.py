@@ -0,0 +1,88 @@
+"""Sharding of page partitions across tap processes."""
+import json
+import zlib
+from typing import List, Optional, Tuple
+
+import click
+
+SHARD_ENV = "TAP_FACEBOOK_PAGES_SHARD"
+
+
+def parse_shard(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse an ``INDEX/COUNT`` shard spec, e.g. ``3/8`` for the third of eight shards."""
+    if not value:
+        return None
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard '{}', expected INDEX/COUNT".format(value))
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard '{}', INDEX must be between 1 and COUNT".format(value))
+    return index, count
+
+
+def in_shard(page_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """Return whether a page belongs to the shard, using a hash that is stable across processes."""
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(str(page_id).encode("utf-8")) % count == index - 1
+
+
+def drop_foreign_partitions(state: dict, shard: Optional[Tuple[int, int]]) -> None:
+    """Remove the partitions of other shards, so a worker only reports the bookmarks it owns."""
+    if shard is None:
+        return
+    for bookmark in state.get("bookmarks", {}).values():
+        if "partitions" in bookmark:
+            bookmark["partitions"] = [
+                x for x in bookmark["partitions"] if in_shard(x.get("context", {}).get("page_id"), shard)
+            ]
+
+
+def merge_states(states: List[dict]) -> dict:
+    """Merge the states of several shards into one.
+
+    Partitions are matched on their context; when two states hold the same partition
+    the later one wins.
+    """
+    merged = {}
+    for state in states:
+        for key, value in state.items():
+            if key != "bookmarks":
+                merged[key] = value
+        bookmarks = merged.setdefault("bookmarks", {})
+        for stream_name, bookmark in state.get("bookmarks", {}).items():
+            target = bookmarks.setdefault(stream_name, {})
+            for key, value in bookmark.items():
+                if key != "partitions":
+                    target[key] = value
+                    continue
+                partitions = {
+                    json.dumps(x.get("context"), sort_keys=True): x for x in target.get("partitions", [])
+                }
+                for partition in value:
+                    partitions[json.dumps(partition.get("context"), sort_keys=True)] = partition
+                target["partitions"] = list(partitions.values())
+    return merged
+
+
+def read_state(path: str) -> dict:
+    """Read a state file, or the last STATE message of a captured tap output."""
+    with open(path) as f:
+        content = f.read()
+    try:
+        return json.loads(content)
+    except ValueError:
+        state = {}
+        for line in content.splitlines():
+            message = json.loads(line) if line.strip() else {}
+            if message.get("type") == "STATE":
+                state = message["value"]
+        return state
+
+
+@click.command(help="Merge the states written by tap-facebook-pages shards into one state file.")
+@click.argument("state_files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def merge_state_cli(state_files):
+    click.echo(json.dumps(merge_states([read_state(x) for x in state_files]), indent=2))
@@ -3,12 +3,15 @@ import time as t
 import datetime
 import re
 import sys
-import copy
 import json
+import contextlib
+import hashlib
+import threading
 from pathlib import Path
-from typing import Any, Dict, Optional, Iterable, cast
+from typing import Any, Dict, Optional, Iterable, NamedTuple, Tuple, cast
 
 import pendulum
+from singer_sdk.helpers._util import utc_now
 from singer_sdk.streams import RESTStream
 import backoff
 import functools
@@ -20,6 +23,15 @@ import urllib.parse
 import requests
 import logging
 
+from tap_facebook_pages.batch import DEFAULT_MAX_BYTES, BatchWriter, ParquetBatchWriter
+from tap_facebook_pages.breaker import ALL_SCOPES, AuthorizationBreaker
+from tap_facebook_pages.columnar import arrow_schema, insight_batch, iter_records, require_pyarrow
+from tap_facebook_pages.conform import get_conformer, parse_timestamp
+from tap_facebook_pages.metric_cache import InvalidMetricCache
+from tap_facebook_pages.scheduler import PageScheduler
+from tap_facebook_pages.throttle import APP_SCOPE, PageThrottledError, ThrottleRegistry, parse_rate_limit
+from tap_facebook_pages.tracing import Tracer
+
 logger = logging.getLogger("tap-facebook-pages")
 logger_handler = logging.StreamHandler(stream=sys.stderr)
 logger.addHandler(logger_handler)
@@ -30,7 +42,22 @@ NEXT_FACEBOOK_PAGE = "NEXT_FACEBOOK_PAGE"
 MAX_RETRY = 5
 SCHEMAS_DIR = Path(__file__).parent / Path("./schemas")
 
-BASE_URL = "https://graph.facebook.com/v12.0/{page_id}"
+API_VERSION = "v12.0"
+GRAPH_URL = "https://graph.facebook.com"
+
+WINDOW_SIZE = 7689600  # 89 days
+MAX_WINDOW_SIZE = 8035200  # 93 days
+CHECKPOINT_KEY = "checkpoint"
+CHECKPOINT_INTERVAL = 30  # seconds between checkpoint STATE messages
+ACTIVITY_KEY = "earliest_activity"
+MIN_PROBE_WINDOWS = 4  # shorter ranges are cheaper to read window by window
+CHANGE_FEED_BATCH = 50  # ids per request, the Graph API maximum
+LIMIT_KEY = "limit"
+DEFAULT_LIMIT = 100
+MIN_LIMIT = 10
+SLOW_RESPONSE = 10  # seconds, slower responses halve the page size
+LARGE_RESPONSE = 4 * 1024 * 1024  # bytes, larger responses halve the page size
+SNAPSHOT_LOOKBACK_DAYS = 28  # days of posts whose lifetime totals every snapshot sync reads again
 
 
 def is_status_code_fn(blacklist=None, whitelist=None):
@@ -57,7 +84,7 @@ def is_status_code_fn(blacklist=None, whitelist=None):
 def retry_handler(details):
     """
         Customize retrying on Exception by updating until with reduced time
-        (until - since) should be 90 days [7689600 -> 89 days + since, because since is included]
+        (until - since) should be 90 days [WINDOW_SIZE -> 89 days + since, because since is included]
     """
     # Don't have to wait, just update 'until' param in prepared request
     details["wait"] = 0
@@ -74,7 +101,7 @@ def retry_handler(details):
             since, until = params.get("since", False), params.get("until", False)
             if since:
                 if not until:
-                    until = [int(since[0]) + 7689600]
+                    until = [int(since[0]) + WINDOW_SIZE]
 
                 days = int(((int(until[0]) - int(since[0])) / 86400) / 2) * 86400
                 new_until = int(since[0]) + days
@@ -89,14 +116,24 @@ def retry_handler(details):
                     'args': args,
                 })
                 message += "Retrying with half period"
+                args[0].tracer.add("halve window", "retry", t.perf_counter(), 0, stream=args[0].name,
+                                   page_id=getattr(args[0], "page_id", None), since=int(since[0]), until=new_until)
 
     logger.info(message + " -- Retry %s/%s", details['tries'], MAX_RETRY)
 
 
+def trace_backoff(details):
+    """Record the backoff sleep before a retried request in the stream's trace."""
+    stream = details["args"][0]
+    stream.tracer.add("backoff", "sleep", t.perf_counter(), details["wait"], stream=stream.name,
+                      page_id=getattr(stream, "page_id", None), tries=details["tries"])
+
+
 def error_handler(fnc):
     @backoff.on_exception(
         backoff.expo,
         requests.exceptions.RequestException,
+        on_backoff=trace_backoff,
         max_tries=MAX_RETRY,
         giveup=lambda e: e.response is not None and 400 <= e.response.status_code < 500,
         factor=2,
@@ -123,11 +160,152 @@ class TooManyDataRequestedError(Exception):
         self.code = code
 
 
+class UnauthorizedError(RuntimeError):
+    pass
+
+
+class InvalidMetricError(RuntimeError):
+    def __init__(self, msg=None, request=None):
+        RuntimeError.__init__(self, msg)
+        # the rejected request, the probes repeat it with fewer metrics
+        self.request = request
+
+
+class PageCursor(NamedTuple):
+    """Position of the next request: a since/until window and the paging cursor inside it."""
+    since: int
+    until: int
+    after: Optional[str] = None
+
+
 class FacebookPagesStream(RESTStream):
     access_tokens = {}
     metrics = []
-    partitions = []
     page_id: str
+    activity_bounds = {}
+    authorization_breaker = AuthorizationBreaker()
+    throttle = ThrottleRegistry()
+    # Graph API permission the stream's edge needs, failures are shared by the streams of a scope
+    permission_scope = "page"
+    probe_activity = False
+    windowed = True
+    # tune the limit param per page from the observed responses
+    adaptive_limit = False
+    # insight streams decode responses into Arrow batches with config['columnar_insights']
+    columnar = False
+    # streams reading posts can fetch them by id from the change feed
+    post_stream = False
+    # page_id -> post ids mentioned by the change feed, None outside change feed mode
+    change_feed_posts = None
+    # invalid metrics are cached per page
+    invalid_metrics = InvalidMetricCache(None, API_VERSION)
+    # the page of the partition being synced
+    page_id = None
+    output_lock = threading.RLock()
+    # bounds the requests in flight across concurrently syncing streams, a no-op context by default
+    request_budget = contextlib.suppress()
+    # sends duplicates of slow requests when config['hedge_percentile'] is set
+    hedger = None
+    # records request, retry, sleep and parse spans when config['trace_path'] is set
+    tracer = Tracer(None)
+    # HTTP/2 transport shared by all streams when config['http2'] is set
+    http_adapter = None
+    # properties added by the tap rather than returned by the API
+    synthetic_fields = ["page_id"]
+    _fields = None
+    _last_checkpoint_time = 0.0
+    _page_partitions = []
+    # windows the current partition may sync before yielding its turn, None for all of them
+    _turn_windows = None
+    _turn_unfinished = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._deferred = []
+        self._deferrals = {}
+        # page_id -> partition state, valid while the partitions list is the one it was built from
+        self._state_index = {}
+        self._state_index_key = None
+        self._conform = None
+        self._adapter_mounted = False
+        # built on first use, the input catalog is only applied after the streams are created
+        self._batch_writer = None
+        self._arrow_schema = None
+        if self.columnar and self.config.get("columnar_insights"):
+            require_pyarrow()
+
+    @property
+    def arrow_schema(self):
+        """Return the Arrow schema of the selected properties in columnar mode, None otherwise."""
+        if self._arrow_schema is None and self.columnar and self.config.get("columnar_insights"):
+            self._arrow_schema = arrow_schema(self.schema, self.deselected_properties)
+        return self._arrow_schema
+
+    @property
+    def batch_writer(self) -> Optional[BatchWriter]:
+        """Return the part file writer of the stream when config['batch_dir'] is set."""
+        if self._batch_writer is None and self.config.get("batch_dir"):
+            max_bytes = self.config.get("batch_max_bytes", DEFAULT_MAX_BYTES)
+            if self.arrow_schema is not None:
+                self._batch_writer = ParquetBatchWriter(self.name, self.config["batch_dir"], self.arrow_schema,
+                                                        max_bytes)
+            else:
+                self._batch_writer = BatchWriter(self.name, self.config["batch_dir"], max_bytes)
+        return self._batch_writer
+
+    @property
+    def partitions(self) -> Iterable[dict]:
+        """Iterate the page partitions, revisiting throttled pages once the API lets them through again."""
+        return self._iter_partitions()
+
+    @partitions.setter
+    def partitions(self, value: list) -> None:
+        self._page_partitions = value
+
+    def _iter_partitions(self) -> Iterable[dict]:
+        self._deferred = []
+        self._deferrals = {}
+        if self.config.get("fair_scheduling") and self.windowed:
+            yield from self._iter_turns()
+        else:
+            yield from self._page_partitions
+        while self._deferred:
+            deferred, self._deferred = self._deferred, []
+            for partition in sorted(deferred, key=lambda x: self.throttle.blocked_until(x["page_id"])):
+                with self.tracer.span("page throttled", "sleep", stream=self.name, page_id=partition["page_id"]):
+                    self.throttle.wait(partition["page_id"])
+                yield partition
+        # the SDK asks for the next partition once the last one is synced, the stream's parts are complete
+        with self.output_lock:
+            for writer in self.batch_writers:
+                writer.close()
+
+    def _iter_turns(self) -> Iterable[dict]:
+        """Yield the partitions turn by turn, each turn syncing the page's next few windows."""
+        scheduler = PageScheduler(self._page_partitions, self.config.get("page_priorities"),
+                                  self.config.get("page_weights"), self.config.get("page_time_budget"))
+        partition = scheduler.next()
+        while partition is not None:
+            self._turn_windows = scheduler.weight(partition)
+            self._turn_unfinished = False
+            started = t.time()
+            yield partition
+            # the SDK has synced the turn when it asks for the next partition
+            if self._turn_unfinished:
+                scheduler.requeue(partition, t.time() - started)
+            partition = scheduler.next()
+        self._turn_windows = None
+        self._turn_unfinished = False
+
+    def defer_partition(self, partition: dict) -> None:
+        """Put a throttled page back at the end of the run, the other pages keep syncing meanwhile."""
+        page_id = partition["page_id"]
+        self._deferrals[page_id] = self._deferrals.get(page_id, 0) + 1
+        if self._deferrals[page_id] > MAX_RETRY:
+            self.logger.warning("Giving up on page {}, still throttled after {} attempts".format(page_id, MAX_RETRY))
+            return
+        self.logger.info("Page {} is throttled, continuing with it later".format(page_id))
+        self._deferred.append(partition)
 
     def request_records(self, partition: Optional[dict]) -> Iterable[dict]:
         """Request records from REST endpoint(s), returning response records.
@@ -135,19 +313,41 @@ class FacebookPagesStream(RESTStream):
         If pagination is detected, pages will be recursed automatically.
         """
         self.logger.info("Reading data for {}".format(partition and partition.get("page_id", False)))
-
-        next_page_token: Any = None
+        if partition:
+            page_id = self.page_id = partition["page_id"]
+            if page_id not in self.access_tokens:
+                self.authorization_breaker.trip(page_id, ALL_SCOPES, self.name, "no page access token")
+            if self.authorization_breaker.is_open(page_id, self.permission_scope):
+                self.authorization_breaker.skip(page_id, self.permission_scope)
+                self.logger.info("Skipping page {}, not authorized for '{}'".format(page_id, self.permission_scope))
+                return
+            if self.throttle.is_blocked(page_id):
+                self.defer_partition(partition)
+                return
+            if self.metrics and not self.valid_metrics:
+                self.logger.info("Skipping {}, all of its metrics are invalid".format(self.name))
+                return
+            if self.post_stream and self.change_feed_posts is not None:
+                yield from self.request_changed_posts(partition)
+                return
+
+        next_page_token: Optional[PageCursor] = partition and self.get_checkpoint_token(partition)
         finished = False
+        failed = False
+        windows = 0
         while not finished:
             prepared_request = self.prepare_request(
                 partition, next_page_token=next_page_token
             )
             try:
-                next_page_token = None
+                previous_token, next_page_token = next_page_token, None
                 resp = self._request_with_backoff(prepared_request)
-                for row in self.parse_response(resp):
-                    yield row
-                previous_token = copy.deepcopy(next_page_token)
+                # the span also covers writing the records, which happens while the rows are yielded
+                with self.tracer.span("parse", "parse", **self.trace_args(prepared_request)) as args:
+                    args["rows"] = 0
+                    for row in self.parse_response(resp):
+                        args["rows"] += 1
+                        yield row
                 next_page_token = self.get_next_page_token(
                     response=resp, previous_token=previous_token
                 )
@@ -159,12 +359,49 @@ class FacebookPagesStream(RESTStream):
                 # Cycle until get_next_page_token() no longer returns a value
                 finished = not next_page_token
 
-                if next_page_token == 'True':
-                    next_page_token = False
+                if partition and next_page_token:
+                    self.save_checkpoint(partition, next_page_token)
+                    # a cursor without 'after' starts the next window, the turn may end here
+                    windows += not next_page_token.after
+                    if self._turn_windows is not None and windows >= self._turn_windows:
+                        self._turn_unfinished = True
+                        finished = True
+
+            except InvalidMetricError as e:
+                if self.isolate_invalid_metrics(partition, e.request):
+                    # retry the same window without the invalid metrics
+                    next_page_token = previous_token
+                    finished = not self.valid_metrics
+                else:
+                    self.logger.warning(e)
+                    finished = True
+                    failed = True
+
+            except PageThrottledError:
+                # keep the checkpoint and come back to the page once it is no longer throttled
+                self.defer_partition(partition)
+                finished = True
+                failed = True
+
+            except UnauthorizedError as e:
+                self.authorization_breaker.trip(partition and partition["page_id"], self.permission_scope,
+                                                self.name, str(e))
+                finished = True
+                failed = True
 
             except Exception as e:
                 self.logger.warning(e)
                 finished = not next_page_token
+                failed = True
+
+        if partition:
+            if not failed and not self._turn_unfinished:
+                # the partition is complete, nothing is left to resume
+                with self.output_lock:
+                    self.get_stream_or_partition_state(partition).pop(CHECKPOINT_KEY, None)
+            # a failed window keeps its checkpoint, so the next run resumes from it
+            self._last_checkpoint_time = t.time()
+            self._write_state_message()
 
     def prepare_request(self, partition: Optional[dict],
                         next_page_token: Optional[Any] = None) -> requests.PreparedRequest:
@@ -174,85 +411,387 @@ class FacebookPagesStream(RESTStream):
 
     @property
     def url_base(self) -> str:
-        return BASE_URL
+        # config['graph_url'] points the tap at another Graph API host, e.g. the scale harness
+        return self.config.get("graph_url", GRAPH_URL) + "/" + API_VERSION + "/{page_id}"
 
-    def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
+    def get_url_params(self, partition: Optional[dict],
+                       next_page_token: Optional[PageCursor] = None) -> Dict[str, Any]:
         self.page_id = partition["page_id"]
-        if next_page_token:
-            return urllib.parse.parse_qs(urllib.parse.urlparse(next_page_token).query)
-
         params = {}
-        starting_datetime = self.get_starting_timestamp(partition)
-        if starting_datetime:
-            start_date_timestamp = int(starting_datetime.timestamp())
-            params.update({"since": start_date_timestamp})
+        if next_page_token:
+            params.update({"since": next_page_token.since, "until": next_page_token.until})
+            if next_page_token.after:
+                params.update({"after": next_page_token.after})
+        else:
+            starting_datetime = self.get_starting_timestamp(partition)
+            if starting_datetime:
+                start_date_timestamp = int(starting_datetime.timestamp())
+                params.update({"since": start_date_timestamp})
 
         if partition["page_id"] in self.access_tokens:
             params.update({"access_token": self.access_tokens[partition["page_id"]]})
         else:
             self.logger.info("Not enough rights for page: " + partition["page_id"])
 
-        params.update({"limit": 100})
+        params.update({"limit": self.get_limit(partition) if self.adaptive_limit else DEFAULT_LIMIT})
         return params
 
-    def get_next_page_token(self, response: requests.Response, previous_token: Optional[Any] = None) -> Any:
-
-        def check_until(params, next_page=False, stream_state=None):
-            if 'until' in params:
-                time = int(t.time()) + 86400  # add one day to the last until time
-                day = int(datetime.timedelta(2).total_seconds())
-                since = int(params['since'][0])
-                if next_page:
-                    until = int(params['until'][0])
-                    if since >= time - day or (time <= until <= time + day):
-                        return None
-                    return next_page
+    @property
+    def limit_bounds(self) -> Tuple[int, int]:
+        return self.config.get("min_limit", MIN_LIMIT), self.config.get("max_limit", DEFAULT_LIMIT)
+
+    def get_limit(self, partition: dict) -> int:
+        """Return the page size learned for the partition, bounded by config['min_limit'] and ['max_limit']."""
+        low, high = self.limit_bounds
+        return min(high, max(low, self.get_stream_or_partition_state(partition).get(LIMIT_KEY, DEFAULT_LIMIT)))
+
+    def tune_limit(self, partition: dict, response: requests.Response, rows: int, limit: int) -> None:
+        """Adapt the page size of the partition to a response requested with ``limit``.
+
+        Slow or large responses halve it, full pages returned fast and small grow it by half.
+        The value is saved in the partition state, so later runs start from it.
+        """
+        elapsed = response.elapsed.total_seconds()
+        size = len(response.content)
+        low, high = self.limit_bounds
+        if elapsed > SLOW_RESPONSE or size > LARGE_RESPONSE:
+            self.set_limit(partition, max(low, limit // 2))
+        elif rows >= limit and elapsed < SLOW_RESPONSE / 4 and size < LARGE_RESPONSE / 4:
+            self.set_limit(partition, min(high, limit + limit // 2))
+
+    def set_limit(self, partition: dict, limit: int) -> None:
+        state = self.get_stream_or_partition_state(partition)
+        if state.get(LIMIT_KEY, DEFAULT_LIMIT) != limit:
+            self.logger.debug("Page size of {} for page {} is now {}".format(self.name, partition["page_id"], limit))
+            with self.output_lock:
+                state[LIMIT_KEY] = limit
+
+    def get_window_params(self, partition: Optional[dict],
+                          next_page_token: Optional[PageCursor] = None) -> Dict[str, Any]:
+        """Return url params bounded to a single since/until time window."""
+        params = FacebookPagesStream.get_url_params(self, partition, next_page_token)
+        time = int(t.time()) + 86400  # add one day to the last until time
+        day = int(datetime.timedelta(1).total_seconds())
+        if not next_page_token:
+            # check difference between start date and state date. Update since if necessary
+            state = self.get_stream_or_partition_state({'page_id': self.page_id})
+            if 'progress_markers' in state and state['progress_markers']:
+                state_date = state['progress_markers']['replication_key_value']
+                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
+                if since > params['since']:
+                    params['since'] = since
+            elif self.probe_activity and not state.get('replication_key_value'):
+                # first sync of the partition: jump over the empty windows before the first post
+                params['since'] = max(params['since'], self.get_activity_lower_bound(partition, params['since']))
+
+            until = params['since'] + WINDOW_SIZE
+            params.update({"until": until if until <= time else time - day})
+        else:
+            until = next_page_token.until
+            if until - next_page_token.since > MAX_WINDOW_SIZE:
+                params['until'] = next_page_token.since + MAX_WINDOW_SIZE
+            if until > time:
+                params['until'] = time - day
+        return params
+
+    def get_activity_lower_bound(self, partition: dict, since: int) -> int:
+        """Return the start of the first window holding a post, probing the API if it is unknown.
+
+        Each probe asks for a single post id between ``since`` and a candidate until, so
+        the first window with data is found by bisecting over the windows instead of
+        requesting every empty window. The bound is shared with the streams reading the
+        same edge and saved in the partition state.
+        """
+        state = self.get_stream_or_partition_state(partition)
+        key = (partition["page_id"], self.path)
+        if ACTIVITY_KEY in state:
+            self.activity_bounds[key] = state[ACTIVITY_KEY]
+        if key not in self.activity_bounds:
+            now = int(t.time())
+            windows = -(-(now - since) // WINDOW_SIZE)
+            if windows <= MIN_PROBE_WINDOWS:
+                return since
+            try:
+                if not self.has_activity(partition, since, now):
+                    self.activity_bounds[key] = now
                 else:
-                    if stream_state and 'progress_markers' in stream_state[0] and stream_state[0]['progress_markers']:
-                        state_date = stream_state[0]['progress_markers']['replication_key_value']
-                        state_date = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                        # return 'True' to identify there is no next token, but the interation should continue
-                        if since != state_date:
-                            return self.paginate(params)
-                    else:
-                        return self.paginate(params)
+                    low, high = 0, windows - 1
+                    while low < high:
+                        middle = (low + high) // 2
+                        if self.has_activity(partition, since, since + (middle + 1) * WINDOW_SIZE):
+                            high = middle
+                        else:
+                            low = middle + 1
+                    self.activity_bounds[key] = since + low * WINDOW_SIZE
+            except Exception as e:
+                # fall back to reading window by window
+                self.logger.warning("Probing earliest activity failed: {}".format(e))
+                return since
+            self.logger.info("Earliest activity of {} for page {} starts at {}".format(
+                self.path, partition["page_id"], self.activity_bounds[key]))
+
+        with self.output_lock:
+            state[ACTIVITY_KEY] = self.activity_bounds[key]
+        return self.activity_bounds[key]
+
+    def has_activity(self, partition: dict, since: int, until: int) -> bool:
+        """Request one post id between since and until to check whether the range holds any data."""
+        params = {"since": since, "until": until, "limit": 1, "fields": "id"}
+        if partition["page_id"] in self.access_tokens:
+            params["access_token"] = self.access_tokens[partition["page_id"]]
+        prepared_request = self.requests_session.prepare_request(
+            requests.Request("GET", self.get_url(partition), params=params)
+        )
+        return bool(self._request_with_backoff(prepared_request).json().get("data"))
+
+    def get_checkpoint_token(self, partition: Optional[dict]) -> Optional[PageCursor]:
+        """Return the cursor of an interrupted window saved in the partition state."""
+        checkpoint = self.get_stream_or_partition_state(partition).get(CHECKPOINT_KEY)
+        if not checkpoint:
+            return None
+
+        self.logger.info("Resuming {} for page {} from window {} - {}".format(
+            self.name, partition["page_id"], checkpoint["since"], checkpoint["until"]))
+        return PageCursor(**checkpoint)
+
+    def save_checkpoint(self, partition: Optional[dict], next_page_token: PageCursor) -> None:
+        """Record the window (and cursor inside it) the next request will fetch.
+
+        Everything before the checkpoint's ``since`` has already been emitted, so a
+        restarted run continues from here. STATE messages are throttled to one per
+        ``CHECKPOINT_INTERVAL`` seconds.
+        """
+        with self.output_lock:
+            self.get_stream_or_partition_state(partition)[CHECKPOINT_KEY] = next_page_token._asdict()
+        now = t.time()
+        if now - self._last_checkpoint_time >= CHECKPOINT_INTERVAL:
+            self._last_checkpoint_time = now
+            self._write_state_message()
+
+    def get_next_page_token(self, response: requests.Response,
+                            previous_token: Optional[PageCursor] = None) -> Optional[PageCursor]:
+        # the window actually requested, retry_handler may have shortened it
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(response.request.url).query)
+        if "since" not in params or "until" not in params:
             return None
+        since, until = int(params["since"][0]), int(params["until"][0])
 
         resp_json = response.json()
+        if self.adaptive_limit and "limit" in params:
+            self.tune_limit({"page_id": self.page_id}, response, len(resp_json['data']), int(params["limit"][0]))
         if not resp_json['data']:
-            params = urllib.parse.parse_qs(urllib.parse.urlparse(response.url).query)
-            return self.paginate(params)
-        # Update: if not page token -> update since & until
-        params = urllib.parse.parse_qs(urllib.parse.urlparse(response.request.url).query)
-        if "paging" in resp_json and "next" in resp_json["paging"]:
-            params = urllib.parse.parse_qs(urllib.parse.urlparse(resp_json["paging"]["next"]).query)
-            return check_until(params=params, next_page=resp_json["paging"]["next"])
-        else:
-            return check_until(params=params, stream_state=[x for x in self.stream_state['partitions'] if
-                                              x['context']['page_id'] == self.page_id])
+            return self.paginate(since, until)
+
+        paging = resp_json.get("paging", {})
+        if "next" in paging:
+            after = paging.get("cursors", {}).get("after")
+            if not after:
+                # time based paging moves the window itself
+                params = urllib.parse.parse_qs(urllib.parse.urlparse(paging["next"]).query)
+                if "since" not in params or "until" not in params:
+                    return None
+                since, until = int(params["since"][0]), int(params["until"][0])
+            time = int(t.time()) + 86400  # add one day to the last until time
+            day = int(datetime.timedelta(2).total_seconds())
+            if since >= time - day or (time <= until <= time + day):
+                return None
+            return PageCursor(since, until, after)
 
-        return None
+        # Update: if not page token -> update since & until
+        state = self.get_stream_or_partition_state({'page_id': self.page_id})
+        if state.get('progress_markers'):
+            state_date = state['progress_markers']['replication_key_value']
+            if since == int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp()):
+                return None
+        return self.paginate(since, until)
 
-    def paginate(self, params):
-        time = int(t.time()) + 86400  # add one day to the last until time
+    def paginate(self, since: int, until: int) -> Optional[PageCursor]:
+        """Return the cursor of the window following since/until, None once the present is reached."""
         day = int(datetime.timedelta(1).total_seconds())
-        params['since'] = params['until']
-        until = int(params['since'][0]) + 7689600  # 8035200
-        since = int(params['since'][0])
+        since = until
+        until = since + WINDOW_SIZE
         if until >= int(t.time()):
             until = int(t.time())
-            if until-since <= day:
+            if until - since <= day:
                 return None
-        params.update({"until": [str(until)]})
-        if "after" in params:
-            del params['after']
-        return params
+        return PageCursor(since, until)
+
+    @property
+    def valid_metrics(self) -> list:
+        """Return the metrics of the stream not known to be invalid for the current page."""
+        return self.invalid_metrics.filter(self.metrics, self.page_id)
+
+    def get_metric_params(self, metrics: list) -> Dict[str, Any]:
+        """Return the params requesting the given metrics, streams without metrics request none."""
+        return {}
+
+    def isolate_invalid_metrics(self, partition: dict, request: Optional[requests.PreparedRequest] = None) -> bool:
+        """Bisect the metric list to find the metrics the API rejects and add them to the cache.
+
+        ``request`` is the rejected request, see ``metrics_accepted``. Returns whether any
+        invalid metric was found.
+        """
+        invalid = self._bisect_metrics(partition, self.valid_metrics, request)
+        if invalid:
+            self.logger.warning("Removing invalid metrics of {} for page {}: {}".format(
+                self.name, partition["page_id"], ", ".join(invalid)))
+            self.invalid_metrics.add(invalid, partition["page_id"])
+        return bool(invalid)
+
+    def _bisect_metrics(self, partition: dict, metrics: list,
+                        request: Optional[requests.PreparedRequest] = None) -> list:
+        if len(metrics) <= 1:
+            return metrics if metrics and not self.metrics_accepted(partition, metrics, request) else []
+        middle = len(metrics) // 2
+        invalid = []
+        for half in (metrics[:middle], metrics[middle:]):
+            if not self.metrics_accepted(partition, half, request):
+                invalid += self._bisect_metrics(partition, half, request) if len(half) > 1 else half
+        return invalid
+
+    def metrics_accepted(self, partition: dict, metrics: list,
+                         request: Optional[requests.PreparedRequest] = None) -> bool:
+        """Repeat the rejected ``request`` with the given metrics to check whether the API accepts all of them.
+
+        The posts edges only evaluate insights for the posts they return, so the probe keeps
+        the window, paging cursor or post ids of the rejected request and asks for one row.
+        Without a request the last day is probed.
+        """
+        if request is not None:
+            url = urllib.parse.urlsplit(request.url)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            url = urllib.parse.urlunsplit(url._replace(query=""))
+        else:
+            until = int(t.time()) - 86400
+            params = {"since": until - 86400, "until": until}
+            url = self.get_url(partition)
+            if partition["page_id"] in self.access_tokens:
+                params["access_token"] = self.access_tokens[partition["page_id"]]
+        if "ids" not in params:
+            params["limit"] = 1
+        params.update(self.get_metric_params(metrics))
+        prepared_request = self.requests_session.prepare_request(requests.Request("GET", url, params=params))
+        try:
+            self._request_with_backoff(prepared_request)
+        except InvalidMetricError:
+            return False
+        except Exception as e:
+            # other failures say nothing about the metrics
+            self.logger.debug(e)
+        return True
+
+    def parse_response(self, response: requests.Response) -> Iterable[dict]:
+        resp_json = response.json()
+        if "data" not in resp_json:
+            # single object responses, e.g. the page itself
+            yield from super().parse_response(response)
+        else:
+            yield from self.parse_rows(resp_json["data"])
+
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        yield from rows
+
+    def emit_batch(self, batch) -> Iterable[dict]:
+        """Write an Arrow batch straight to the Parquet sink, or yield its rows as records."""
+        if not isinstance(self.batch_writer, ParquetBatchWriter):
+            yield from iter_records(batch)
+            return
+        self.batch_writer.write_batch(batch)
+        if self.replication_key and batch.num_rows:
+            # no record passes the SDK, so the bookmark takes the batch maximum
+            column = batch.column(batch.schema.get_field_index(self.replication_key))
+            latest = max((x for x in column.to_pylist() if x), key=parse_timestamp, default=None)
+            if latest:
+                self._increment_stream_state({self.replication_key: latest}, context={"page_id": self.page_id})
+
+    def request_changed_posts(self, partition: dict) -> Iterable[dict]:
+        """Fetch the posts of the change feed by id, CHANGE_FEED_BATCH ids per request.
+
+        Replication bookmarks stay where the last window scan left them.
+        """
+        self.page_id = partition["page_id"]
+        post_ids = self.change_feed_posts.get(self.page_id, [])
+        self.logger.info("Reading {} changed posts for {}".format(len(post_ids), self.page_id))
+        position = 0
+        while position < len(post_ids):
+            try:
+                posts = self.request_posts_by_id(post_ids[position:position + CHANGE_FEED_BATCH])
+            except InvalidMetricError as e:
+                if self.isolate_invalid_metrics(partition, e.request) and self.valid_metrics:
+                    # the same posts again, without the invalid metrics
+                    continue
+                self.logger.warning(e)
+                return
+            except PageThrottledError:
+                self.defer_partition(partition)
+                return
+            except UnauthorizedError as e:
+                self.authorization_breaker.trip(self.page_id, self.permission_scope, self.name, str(e))
+                return
+            for post in posts:
+                try:
+                    rows = list(self.parse_rows([post]))
+                except Exception as e:
+                    self.logger.warning("Skipping post {}: {}".format(post.get("id"), e))
+                    continue
+                yield from rows
+            position += CHANGE_FEED_BATCH
+
+    def request_posts_by_id(self, post_ids: list) -> list:
+        """Request posts by id, retrying a failed batch in halves so one deleted post does not drop the others.
+
+        Invalid metrics fail every post alike, they are raised for the caller to remove.
+        """
+        params = {
+            "ids": ",".join(post_ids),
+            "fields": self.get_fields(),
+            "access_token": self.access_tokens[self.page_id],
+        }
+        prepared_request = self.requests_session.prepare_request(
+            requests.Request("GET", self.url_base.format(page_id=""), params=params)
+        )
+        try:
+            return list(self._request_with_backoff(prepared_request).json().values())
+        except (PageThrottledError, UnauthorizedError, InvalidMetricError):
+            raise
+        except Exception as e:
+            if len(post_ids) == 1:
+                self.logger.warning("Skipping post {}: {}".format(post_ids[0], e))
+                return []
+            middle = len(post_ids) // 2
+            return self.request_posts_by_id(post_ids[:middle]) + self.request_posts_by_id(post_ids[middle:])
 
     def post_process(self, row: dict, partition: dict) -> dict:
         if "page_id" in partition:
             row["page_id"] = partition["page_id"]
         return row
 
+    def get_fields(self) -> str:
+        """Return the ``fields`` projection of the properties selected in the input catalog.
+
+        Object properties whose sub-properties carry their own metadata are projected
+        as ``name{sub,...}``. ``config['columns']`` still takes precedence.
+        """
+        if 'columns' in self.config:
+            return ','.join(self.config['columns'])
+        if self._fields is None:
+            fields = self._project_fields(self.schema, ())
+            required = [x for x in self.primary_keys + [self.replication_key] if x and x not in fields]
+            self._fields = ','.join(required + [x for x in fields if x not in self.synthetic_fields])
+        return self._fields
+
+    def _project_fields(self, schema: dict, breadcrumb: tuple) -> list:
+        fields = []
+        for name, prop in schema.get("properties", {}).items():
+            prop_breadcrumb = breadcrumb + ("properties", name)
+            if not self.mask[prop_breadcrumb]:
+                continue
+            nested = any(len(x) > len(prop_breadcrumb) and x[:len(prop_breadcrumb)] == prop_breadcrumb
+                         for x in self.metadata)
+            sub_fields = self._project_fields(prop, prop_breadcrumb) if nested else []
+            fields.append("{}{{{}}}".format(name, ",".join(sub_fields)) if sub_fields else name)
+        return fields
+
     @property
     def _singer_metadata(self) -> dict:
         """Return metadata object (dict) as specified in the Singer spec.
@@ -280,33 +819,167 @@ class FacebookPagesStream(RESTStream):
         )
         return md
 
+    # Output and state changes hold output_lock: streams may sync concurrently and
+    # every STATE message serializes the whole tap state.
+
+    def conform(self, record: dict) -> dict:
+        if self._conform is None:
+            self._conform = get_conformer(self.name, self.schema, self.logger, self.mask)
+        return self._conform(record)
+
+    @property
+    def deselected_properties(self) -> list:
+        """Return the top level properties deselected in the input catalog."""
+        return [x for x in self.schema.get("properties", {}) if not self.mask[("properties", x)]]
+
+    def _write_record_message(self, record: dict) -> None:
+        if self.batch_writer is not None:
+            self.batch_writer.write(self.conform(record))
+        elif self.config.get("stream_maps"):
+            with self.output_lock:
+                super()._write_record_message(record)
+        else:
+            # the SDK's message without its generic per property conforming
+            message = singer.RecordMessage(stream=self.name, record=self.conform(record), time_extracted=utc_now())
+            with self.output_lock:
+                singer.write_message(message)
+
+    @property
+    def batch_writers(self) -> list:
+        """Return the writers of the records a STATE message of this stream covers."""
+        return [self.batch_writer] if self.batch_writer is not None else []
+
+    def _write_state_message(self) -> None:
+        with self.output_lock:
+            # announce the written records before the state that covers them
+            for writer in self.batch_writers:
+                writer.flush()
+            if any(x.pending for x in self.batch_writers):
+                # checkpoints wait for the open part, it is cut by size or at the end of the stream
+                return
+            super()._write_state_message()
+
+    def _write_schema_message(self) -> None:
+        with self.output_lock:
+            super()._write_schema_message()
+
+    def finalize_state_progress_markers(self, state: Optional[dict] = None) -> None:
+        with self.output_lock:
+            super().finalize_state_progress_markers(state)
+
+    def _increment_stream_state(self, latest_record: Dict[str, Any], *, context: Optional[dict] = None) -> None:
+        if self.post_stream and self.change_feed_posts is not None:
+            # changed posts are no window scan, advancing the bookmark would skip the posts before them
+            return
+        with self.output_lock:
+            if self.replication_key and context:
+                # only a new maximum changes the bookmark, each distinct timestamp is parsed once
+                value = latest_record.get(self.replication_key)
+                markers = self.get_context_state(context).get("progress_markers")
+                bookmark = markers.get("replication_key_value") if isinstance(markers, dict) else None
+                if isinstance(value, str) and isinstance(bookmark, str) and \
+                        parse_timestamp(value) <= parse_timestamp(bookmark):
+                    return
+            super()._increment_stream_state(latest_record, context=context)
+
+    def get_context_state(self, context: Optional[dict]) -> dict:
+        """Return the state of a page partition from an index instead of scanning the partitions list."""
+        if not context or list(context) != ["page_id"]:
+            return super().get_context_state(context)
+        with self.output_lock:
+            partitions = self.stream_state.setdefault("partitions", [])
+            if self._state_index_key != (id(partitions), len(partitions)):
+                self._state_index = {
+                    x["context"]["page_id"]: x for x in partitions if list(x.get("context", {})) == ["page_id"]
+                }
+            state = self._state_index.get(context["page_id"])
+            if state is None:
+                state = {"context": dict(context)}
+                partitions.append(state)
+                self._state_index[context["page_id"]] = state
+            self._state_index_key = (id(partitions), len(partitions))
+        return state
+
     def get_stream_or_partition_state(self, partition: Optional[dict]) -> dict:
         """Return partition state if applicable; else return stream state."""
-        state = self.stream_state
-        if partition:
-            state = self.get_context_state(partition)
+        with self.output_lock:
+            state = self.stream_state
+            if partition:
+                state = self.get_context_state(partition)
 
-        if "progress_markers" in state and isinstance(state.get("progress_markers", False), list):
-            state["progress_markers"] = {}
+            if "progress_markers" in state and isinstance(state.get("progress_markers", False), list):
+                state["progress_markers"] = {}
         return state
 
+    @property
+    def requests_session(self) -> requests.Session:
+        session = super().requests_session
+        if self.http_adapter is not None and not self._adapter_mounted:
+            session.mount("https://", self.http_adapter)
+            session.mount("http://", self.http_adapter)
+            self._adapter_mounted = True
+        return session
+
+    def trace_args(self, prepared_request: requests.PreparedRequest) -> dict:
+        """Return the stream, page and window a request is tagged with in the trace."""
+        if not self.tracer.enabled:
+            return {}
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(prepared_request.url).query)
+        args = {"stream": self.name, "page_id": getattr(self, "page_id", None)}
+        for name in ("since", "until", "after", "limit"):
+            if name in params:
+                args[name] = params[name][0]
+        return args
+
+    def send_request(self, prepared_request: requests.PreparedRequest) -> requests.Response:
+        if self.hedger is None:
+            return self.requests_session.send(prepared_request)
+        return self.hedger.send(self.name, self.requests_session, prepared_request, self.request_budget)
+
     @error_handler
     def _request_with_backoff(self, prepared_request) -> requests.Response:
-        response = self.requests_session.send(prepared_request)
+        for _ in range(MAX_RETRY):
+            if self.page_id and self.throttle.is_blocked(self.page_id):
+                # another stream was throttled on this page, don't spend the request
+                raise PageThrottledError(self.page_id, self.throttle.blocked_until(self.page_id) - t.time())
+            if self.throttle.is_blocked(APP_SCOPE):
+                with self.tracer.span("app throttled", "sleep", stream=self.name, page_id=self.page_id):
+                    self.throttle.wait(APP_SCOPE)
+            with self.request_budget:
+                with self.tracer.span("request", "http", **self.trace_args(prepared_request)) as args:
+                    response = self.send_request(prepared_request)
+                    args["status"] = response.status_code
+            rate_limit = parse_rate_limit(response) if response.status_code >= 400 else None
+            if not rate_limit:
+                break
+            # wait exactly as long as the API asks, only pausing the throttled page
+            scope, wait = rate_limit
+            if scope != APP_SCOPE:
+                self.throttle.block(self.page_id, wait)
+                raise PageThrottledError(self.page_id, wait)
+            self.logger.info("Rate limited, waiting {} seconds as requested by the API".format(int(wait)))
+            self.throttle.block(APP_SCOPE, wait)
+
         if response.status_code in [401, 403]:
             # self.logger.info("Skipping request to {}".format(prepared_request.url))
             self.logger.info(
                 f"Reason: {response.status_code} - {str(response.content)}"
             )
-            raise RuntimeError(
+            raise UnauthorizedError(
                 "Requested resource was unauthorized, forbidden, or not found."
             )
         elif response.status_code >= 400:
             # retry by changing 'until' param
             error = json.loads(response.content.decode("utf-8")).get("error", {})
             if error.get("code", False) == 1 and error.get("error_subcode", ) == 99:
+                if self.adaptive_limit:
+                    # ask for fewer rows per page from now on, besides the shorter window of the retry
+                    partition = {"page_id": self.page_id}
+                    self.set_limit(partition, max(self.limit_bounds[0], self.get_limit(partition) // 2))
                 message = error.get("message", False) or "Too many data requested"
                 raise TooManyDataRequestedError(message, code=500)
+            if error.get("code", False) == 100 and "metric" in error.get("message", "").lower():
+                raise InvalidMetricError(error["message"], prepared_request)
 
             raise RuntimeError(
                 f"Error making request to API: {prepared_request.url} "
@@ -325,13 +998,12 @@ class Page(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = None
     forced_replication_method = "FULL_TABLE"
+    windowed = False
     schema_filepath = SCHEMAS_DIR / "page.json"
 
     def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
         params = super().get_url_params(partition, next_page_token)
-        fields = ','.join(self.config['columns']) if 'columns' in self.config else ','.join(
-            self.schema["properties"].keys())
-        params.update({"fields": fields})
+        params.update({"fields": self.get_fields()})
         return params
 
     def post_process(self, row: dict, stream_or_partition_state: dict) -> dict:
@@ -345,43 +1017,19 @@ class Posts(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = "created_time"
     replication_method = "INCREMENTAL"
+    probe_activity = True
+    post_stream = True
+    adaptive_limit = True
+    permission_scope = "posts"
     schema_filepath = SCHEMAS_DIR / "posts.json"
 
     def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
-        if next_page_token is None or isinstance(next_page_token, str):
-            params = super().get_url_params(partition, next_page_token)
-        else:
-            params = next_page_token
-        time = int(t.time()) + 86400  # add one day to the last until time
-        day = int(datetime.timedelta(1).total_seconds())
-        if not next_page_token:
-            # check difference between start date and state date. Update since if necessary
-            state = self.get_stream_or_partition_state({'page_id': self.page_id})
-            if 'progress_markers' in state and state['progress_markers']:
-                state_date = state['progress_markers']['replication_key_value']
-                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                if since > params['since']:
-                    params['since'] = since
-
-            until = params['since'] + 7689600  # 8035200
-            params.update({"until": until if until <= time else time - day})
-        else:
-            until = params['until'][0]
-            since = params['since'][0]
-            difference = (int(until) - int(since))
-            if difference > 8035200:
-                params['until'][0] = int(until) - (difference - 8035200)
-            if int(until) > time:
-                params['until'][0] = str(time - day)
-
-        fields = ','.join(self.config['columns']) if 'columns' in self.config else ','.join(
-            self.schema["properties"].keys())
-        params.update({"fields": fields})
+        params = self.get_window_params(partition, next_page_token)
+        params.update({"fields": self.get_fields()})
         return params
 
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        resp_json = response.json()
-        for row in resp_json["data"]:
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        for row in rows:
             row["page_id"] = self.page_id
             yield row
 
@@ -393,41 +1041,22 @@ class PostTaggedProfile(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = "post_created_time"
     replication_method = "INCREMENTAL"
+    probe_activity = True
+    post_stream = True
+    adaptive_limit = True
+    permission_scope = "posts"
     schema_filepath = SCHEMAS_DIR / "post_tagged_profile.json"
 
     def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
-        if next_page_token is None or isinstance(next_page_token, str):
-            params = super().get_url_params(partition, next_page_token)
-        else:
-            params = next_page_token
-        time = int(t.time()) + 86400  # add one day to the last until time
-        day = int(datetime.timedelta(1).total_seconds())
-        if not next_page_token:
-            # check difference between start date and state date. Update since if necessary
-            state = self.get_stream_or_partition_state({'page_id': self.page_id})
-            if 'progress_markers' in state and state['progress_markers']:
-                state_date = state['progress_markers']['replication_key_value']
-                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                if since > params['since']:
-                    params['since'] = since
-
-            until = params['since'] + 7689600  # 8035200
-            params.update({"until": until if until <= time else time - day})
-        else:
-            until = params['until'][0]
-            since = params['since'][0]
-            difference = (int(until) - int(since))
-            if difference > 8035200:
-                params['until'][0] = int(until) - (difference - 8035200)
-            if int(until) > time:
-                params['until'][0] = str(time - day)
-
-        params.update({"fields": "id,created_time,to"})
+        params = self.get_window_params(partition, next_page_token)
+        params.update({"fields": self.get_fields()})
         return params
 
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        resp_json = response.json()
-        for row in resp_json["data"]:
+    def get_fields(self) -> str:
+        return "id,created_time,to"
+
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        for row in rows:
             parent_info = {
                 "page_id": self.page_id,
                 "post_id": row["id"],
@@ -439,6 +1068,63 @@ class PostTaggedProfile(FacebookPagesStream):
                     yield attachment
 
 
+def content_hash(value: dict) -> str:
+    """Return a hash of a JSON object that does not depend on the order of its keys."""
+    return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class AttachmentMedia(FacebookPagesStream):
+    """The distinct media and target objects of the post attachments, keyed by their content hash.
+
+    The stream sends no request of its own: with ``config['dedup_attachment_media']``
+    post_attachments emits each object the first time it appears in the run and only
+    references it by ``media_hash`` / ``target_hash``.
+    """
+    name = "attachment_media"
+    tap_stream_id = "attachment_media"
+    path = "/posts"
+    primary_keys = ["hash"]
+    replication_key = None
+    forced_replication_method = "FULL_TABLE"
+    windowed = False
+    schema_filepath = SCHEMAS_DIR / "attachment_media.json"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hashes = set()
+        self._schema_sent = False
+
+    @property
+    def partitions(self) -> Optional[list]:
+        return None
+
+    @partitions.setter
+    def partitions(self, value: list) -> None:
+        pass
+
+    def request_records(self, partition: Optional[dict]) -> Iterable[dict]:
+        yield from ()
+
+    def reset(self) -> None:
+        """Forget the emitted objects, a repeated sync writes them and the schema to its new output."""
+        with self.output_lock:
+            self._hashes.clear()
+            self._schema_sent = False
+
+    def reference(self, kind: str, value: dict) -> str:
+        """Emit a media or target object unless it was already emitted, returning its hash."""
+        digest = content_hash(value)
+        with self.output_lock:
+            if digest not in self._hashes:
+                self._hashes.add(digest)
+                if not self._schema_sent:
+                    # post_attachments may sync before this stream announces its schema
+                    self._schema_sent = True
+                    self._write_schema_message()
+                self._write_record_message({"hash": digest, "kind": kind, kind: value})
+        return digest
+
+
 class PostAttachments(FacebookPagesStream):
     name = "post_attachments"
     tap_stream_id = "post_attachments"
@@ -446,42 +1132,25 @@ class PostAttachments(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = "post_created_time"
     replication_method = "INCREMENTAL"
+    probe_activity = True
+    post_stream = True
+    adaptive_limit = True
+    permission_scope = "posts"
     schema_filepath = SCHEMAS_DIR / "post_attachments.json"
 
     def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
-        if next_page_token is None or isinstance(next_page_token, str):
-            params = super().get_url_params(partition, next_page_token)
-        else:
-            params = next_page_token
-        time = int(t.time()) + 86400  # add one day to the last until time
-        day = int(datetime.timedelta(1).total_seconds())
-        if not next_page_token:
-            # check difference between start date and state date. Update since if necessary
-            state = self.get_stream_or_partition_state({'page_id': self.page_id})
-            if 'progress_markers' in state and state['progress_markers']:
-                state_date = state['progress_markers']['replication_key_value']
-                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                if since > params['since']:
-                    params['since'] = since
-
-            until = params['since'] + 7689600  # 8035200
-            params.update({"until": until if until <= time else time - day})
-        else:
-            until = params['until'][0]
-            since = params['since'][0]
-            difference = (int(until) - int(since))
-            if difference > 8035200:
-                params['until'][0] = int(until) - (difference - 8035200)
-            if int(until) > time:
-                params['until'][0] = str(time - day)
+        params = self.get_window_params(partition, next_page_token)
+        params.update({"fields": self.get_fields()})
+        return params
 
-        params.update({"fields": "id,created_time,attachments"})
+    # the attachment_media stream, set by the tap when config['dedup_attachment_media'] is enabled
+    media_stream = None
 
-        return params
+    def get_fields(self) -> str:
+        return "id,created_time,attachments"
 
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        resp_json = response.json()
-        for row in resp_json["data"]:
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        for row in rows:
             parent_info = {
                 "page_id": self.page_id,
                 "post_id": row["id"],
@@ -492,10 +1161,27 @@ class PostAttachments(FacebookPagesStream):
                     if "subattachments" in attachment:
                         for sub_attachment in attachment["subattachments"]["data"]:
                             sub_attachment.update(parent_info)
-                            yield sub_attachment
+                            yield self.dedup_media(sub_attachment)
                         attachment.pop("subattachments")
                     attachment.update(parent_info)
-                    yield attachment
+                    yield self.dedup_media(attachment)
+
+    def dedup_media(self, attachment: dict) -> dict:
+        """Replace the media and target objects with references to the attachment_media stream."""
+        if self.media_stream is not None:
+            for kind in ("media", "target"):
+                if isinstance(attachment.get(kind), dict):
+                    attachment[kind + "_hash"] = self.media_stream.reference(kind, attachment.pop(kind))
+        return attachment
+
+    @property
+    def batch_writers(self) -> list:
+        # the media referenced by the records a state covers are announced with them, attachment_media
+        # may sync before them or in another thread
+        writers = super().batch_writers
+        if self.media_stream is not None and self.media_stream.batch_writer is not None:
+            writers.append(self.media_stream.batch_writer)
+        return writers
 
 
 class PageInsights(FacebookPagesStream):
@@ -505,41 +1191,37 @@ class PageInsights(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = None
     forced_replication_method = "FULL_TABLE"
+    permission_scope = "insights"
+    columnar = True
     schema_filepath = SCHEMAS_DIR / "page_insights.json"
 
     def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
-        if next_page_token is None or isinstance(next_page_token, str):
-            params = super().get_url_params(partition, next_page_token)
-        else:
-            params = next_page_token
-        time = int(t.time()) + 86400  # add one day to the last until time
-        day = int(datetime.timedelta(1).total_seconds())
-        if not next_page_token:
-            # check difference between start date and state date. Update since if necessary
-            state = self.get_stream_or_partition_state({'page_id': self.page_id})
-            if 'progress_markers' in state and state['progress_markers']:
-                state_date = state['progress_markers']['replication_key_value']
-                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                if since > params['since']:
-                    params['since'] = since
+        params = self.get_window_params(partition, next_page_token)
+        params.update(self.get_metric_params(self.valid_metrics))
+        return params
 
-            until = params['since'] + 7689600  # 8035200
-            params.update({"until": until if until <= time else time - day})
-        else:
-            until = params['until'][0]
-            since = params['since'][0]
-            difference = (int(until) - int(since))
-            if difference > 8035200:
-                params['until'][0] = int(until) - (difference - 8035200)
-            if int(until) > time:
-                params['until'][0] = str(time - day)
-
-        params.update({"metric": ",".join(self.metrics)})
+    def get_metric_params(self, metrics: list) -> Dict[str, Any]:
+        params = {"metric": ",".join(metrics)}
+        # the API takes a single period, several ones are filtered while parsing
+        if self.periods and len(self.periods) == 1:
+            params["period"] = self.periods[0]
         return params
 
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        resp_json = response.json()
-        for row in resp_json["data"]:
+    @property
+    def periods(self) -> Optional[list]:
+        """Return the periods to sync from config['stream_periods'] or config['periods'], None for all."""
+        return self.config.get("stream_periods", {}).get(self.name) or self.config.get("periods")
+
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        periods = self.periods
+        if self.arrow_schema is not None:
+            metrics = (({"name": x["name"], "period": x["period"], "title": x["title"], "id": x["id"],
+                         "page_id": self.page_id}, x) for x in rows if not periods or x["period"] in periods)
+            yield from self.emit_batch(insight_batch(metrics, self.arrow_schema))
+            return
+        for row in rows:
+            if periods and row["period"] not in periods:
+                continue
             base_item = {
                 "name": row["name"],
                 "period": row["period"],
@@ -571,41 +1253,82 @@ class PostInsights(FacebookPagesStream):
     primary_keys = ["id"]
     replication_key = "post_created_time"
     replication_method = "INCREMENTAL"
+    probe_activity = True
+    post_stream = True
+    adaptive_limit = True
+    permission_scope = "insights"
+    columnar = True
+    snapshot_time = None
     schema_filepath = SCHEMAS_DIR / "post_insights.json"
 
-    def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
-        if next_page_token is None or isinstance(next_page_token, str):
-            params = super().get_url_params(partition, next_page_token)
-        else:
-            params = next_page_token
-        time = int(t.time()) + 86400  # add one day to the last until time
-        day = int(datetime.timedelta(1).total_seconds())
-        if not next_page_token:
-            # check difference between start date and state date. Update since if necessary
-            state = self.get_stream_or_partition_state({'page_id': self.page_id})
-            if 'progress_markers' in state and state['progress_markers']:
-                state_date = state['progress_markers']['replication_key_value']
-                since = int(cast(datetime.datetime, pendulum.parse(state_date)).timestamp())
-                if since > params['since']:
-                    params['since'] = since
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.snapshot:
+            # every sync adds a row per post and metric with its current totals
+            self.primary_keys = self.primary_keys + ["snapshot_time"]
 
-            until = params['since'] + 7689600  # 8035200
-            params.update({"until": until if until <= time else time - day})
-        else:
-            until = params['until'][0]
-            since = params['since'][0]
-            difference = (int(until) - int(since))
-            if difference > 8035200:
-                params['until'][0] = int(until) - (difference - 8035200)
-            if int(until) > time:
-                params['until'][0] = str(time - day)
-
-        params.update({"fields": "id,created_time,insights.metric(" + ",".join(self.metrics) + ")"})
+    def get_starting_timestamp(self, partition: Optional[dict]) -> Optional[datetime.datetime]:
+        """Return the start of the sync, in snapshot mode at most ``snapshot_lookback_days`` ago.
+
+        The lifetime totals of recent posts still grow, so snapshot syncs read the posts
+        of the lookback period again whatever the bookmark, but not before the start date.
+        """
+        starting_timestamp = super().get_starting_timestamp(partition)
+        if not self.snapshot or starting_timestamp is None:
+            return starting_timestamp
+        lookback = utc_now() - datetime.timedelta(days=self.config.get("snapshot_lookback_days",
+                                                                       SNAPSHOT_LOOKBACK_DAYS))
+        return min(starting_timestamp, max(lookback, pendulum.parse(self.config["start_date"])))
+
+    def get_url_params(self, partition: Optional[dict], next_page_token: Optional[Any] = None) -> Dict[str, Any]:
+        params = self.get_window_params(partition, next_page_token)
+        params.update({"fields": self.get_fields()})
         return params
 
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        resp_json = response.json()
-        for row in resp_json["data"]:
+    def get_fields(self) -> str:
+        return self.get_metric_params(self.valid_metrics)["fields"]
+
+    def get_metric_params(self, metrics: list) -> Dict[str, Any]:
+        period = ".period(lifetime)" if self.snapshot else ""
+        return {"fields": "id,created_time,insights.metric(" + ",".join(metrics) + ")" + period}
+
+    @property
+    def snapshot(self) -> bool:
+        """Return whether the stream syncs lifetime totals only, see config['snapshot_streams']."""
+        streams = self.config.get("snapshot_streams", [])
+        return "*" in streams or self.name in streams
+
+    def _iter_partitions(self) -> Iterable[dict]:
+        # every snapshot row of a sync carries the time the sync started
+        self.snapshot_time = utc_now().isoformat()
+        yield from super()._iter_partitions()
+
+    def iter_metrics(self, rows: list) -> Iterable[tuple]:
+        """Yield the (base item, insight) pairs of the posts, base items shared by a post's metrics."""
+        for row in rows:
+            post = {"post_id": row["id"], "page_id": self.page_id, "post_created_time": row["created_time"]}
+            if self.snapshot:
+                post["snapshot_time"] = self.snapshot_time
+            for insights in row["insights"]["data"]:
+                base_item = dict(post, name=insights["name"], period=insights["period"], title=insights["title"],
+                                 description=insights["description"], id=insights["id"])
+                yield base_item, insights
+
+    def parse_rows(self, rows: list) -> Iterable[dict]:
+        if self.arrow_schema is not None:
+            yield from self.emit_batch(insight_batch(self.iter_metrics(rows), self.arrow_schema))
+            return
+        if self.snapshot:
+            # one row per post and metric, split by context for metrics broken down by type
+            for base_item, insights in self.iter_metrics(rows):
+                value = (insights.get("values") or [{}])[-1].get("value")
+                if isinstance(value, dict):
+                    for key, item in value.items():
+                        yield dict(base_item, context=key, value=item)
+                else:
+                    yield dict(base_item, value=value)
+            return
+        for row in rows:
             for insights in row["insights"]["data"]:
                 base_item = {
                     "post_id": row["id"],
@@ -1,6 +1,11 @@
 """facebook-pages tap class."""
 import json
 import logging
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import PurePath
 from typing import List, Union
 import requests
@@ -8,16 +13,30 @@ import singer
 from singer_sdk import Tap, Stream
 from singer_sdk.typing import (
     ArrayType,
+    BooleanType,
     DateTimeType,
+    IntegerType,
+    NumberType,
+    ObjectType,
     PropertiesList,
     Property,
     StringType,
 )
 
+from tap_facebook_pages.breaker import AuthorizationBreaker
+from tap_facebook_pages.changefeed import read_change_feed
+from tap_facebook_pages.daemon import daemon_cli
+from tap_facebook_pages.hedging import DEFAULT_BUDGET, Hedger
 from tap_facebook_pages.insights import INSIGHT_STREAMS
+from tap_facebook_pages.metric_cache import InvalidMetricCache
+from tap_facebook_pages.planner import plan_cli
+from tap_facebook_pages.sharding import SHARD_ENV, drop_foreign_partitions, in_shard, parse_shard
 from tap_facebook_pages.streams import (
-    Page, Posts, PostAttachments, PostTaggedProfile
+    API_VERSION, GRAPH_URL, AttachmentMedia, Page, Posts, PostAttachments, PostTaggedProfile
 )
+from tap_facebook_pages.throttle import ThrottleRegistry
+from tap_facebook_pages.tracing import Tracer
+from tap_facebook_pages.transport import Http2Adapter
 
 PLUGIN_NAME = "tap-facebook-pages"
 
@@ -26,12 +45,13 @@ STREAM_TYPES = [
     Posts,
     PostAttachments,
     PostTaggedProfile,
+    AttachmentMedia,
 ]
 
 FACEBOOK_API_VERSION = "v12.0"
-ACCOUNTS_URL = "https://graph.facebook.com/{version}/{user_id}/accounts"
-ME_URL = "https://graph.facebook.com/{version}/me".format(version=FACEBOOK_API_VERSION)
-BASE_URL = "https://graph.facebook.com/{page_id}"
+ACCOUNTS_URL = "{graph_url}/{version}/{user_id}/accounts"
+ME_URL = "{graph_url}/{version}/me"
+BASE_URL = "{graph_url}/{page_id}"
 
 session = requests.Session()
 
@@ -45,6 +65,30 @@ class TapFacebookPages(Tap):
         Property("access_token", StringType, required=True),
         Property("page_ids", ArrayType(StringType), required=True),
         Property("start_date", DateTimeType, required=True),
+        Property("shard", StringType),
+        Property("change_feed", StringType),
+        Property("invalid_metric_cache", StringType),
+        Property("batch_dir", StringType),
+        Property("batch_max_bytes", IntegerType),
+        Property("periods", ArrayType(StringType)),
+        Property("stream_periods", ObjectType()),
+        Property("max_parallel_streams", IntegerType),
+        Property("max_inflight_requests", IntegerType),
+        Property("graph_url", StringType),
+        Property("hedge_percentile", NumberType),
+        Property("hedge_budget", NumberType),
+        Property("min_limit", IntegerType),
+        Property("max_limit", IntegerType),
+        Property("fair_scheduling", BooleanType),
+        Property("page_priorities", ObjectType()),
+        Property("page_weights", ObjectType()),
+        Property("page_time_budget", NumberType),
+        Property("trace_path", StringType),
+        Property("http2", BooleanType),
+        Property("dedup_attachment_media", BooleanType),
+        Property("columnar_insights", BooleanType),
+        Property("snapshot_streams", ArrayType(StringType)),
+        Property("snapshot_lookback_days", IntegerType),
     ).to_dict()
 
     def __init__(self, config: Union[PurePath, str, dict, None] = None,
@@ -53,9 +97,19 @@ class TapFacebookPages(Tap):
         super().__init__(config, catalog, state, parse_env_config)
         # update page access tokens on sync
         page_ids = self.config['page_ids']
+        drop_foreign_partitions(self.state, self.shard)
+
+    @property
+    def shard(self):
+        """Return the (index, count) shard of this process, the --shard flag taking precedence over config."""
+        return parse_shard(os.environ.get(SHARD_ENV) or self.config.get("shard"))
+
+    @property
+    def graph_url(self) -> str:
+        return self.config.get("graph_url", GRAPH_URL)
 
     def exchange_token(self, page_id: str, access_token: str):
-        url = BASE_URL.format(page_id=page_id)
+        url = BASE_URL.format(graph_url=self.graph_url, page_id=page_id)
         data = {
             'fields': 'access_token,name',
             'access_token': access_token
@@ -79,7 +133,7 @@ class TapFacebookPages(Tap):
         params = {
             "access_token": access_token,
         }
-        response = session.get(ME_URL, params=params)
+        response = session.get(ME_URL.format(graph_url=self.graph_url, version=FACEBOOK_API_VERSION), params=params)
         response_json = response.json()
 
         if response.status_code != 200:
@@ -92,7 +146,8 @@ class TapFacebookPages(Tap):
         user_id = response_json["id"]
         next_page_cursor = True
         while next_page_cursor:
-            response = session.get(ACCOUNTS_URL.format(version=FACEBOOK_API_VERSION, user_id=user_id), params=params)
+            response = session.get(ACCOUNTS_URL.format(graph_url=self.graph_url, version=FACEBOOK_API_VERSION,
+                                                       user_id=user_id), params=params)
             response_json = response.json()
             if response.status_code != 200:
                 if response.status_code in (4, 17, 32, 613):
@@ -109,32 +164,149 @@ class TapFacebookPages(Tap):
                 self.logger.info("Get token for page '{}'".format(pages["name"]))
                 self.access_tokens[page_id] = pages["access_token"]
 
+    def load_access_tokens(self) -> None:
+        """Fetch the missing access tokens of the synced pages into the dict shared with the streams."""
+        self.streams  # make sure the streams and their shared token dict exist
+        page_ids = [x["page_id"] for x in self.partitions if x["page_id"] not in self.access_tokens]
+        if len(page_ids) > 1:
+            self.get_pages_tokens(page_ids, self.config['access_token'])
+        elif page_ids:
+            self.access_tokens[page_ids[0]] = self.exchange_token(page_ids[0], self.config['access_token'])
+
+    def reset_run(self) -> None:
+        """Prepare a repeated sync of this instance, as the daemon mode runs them.
+
+        Authorization failures are forgotten and the tokens of the failed pages fetched
+        again, the change feed is read again and the attachment media are emitted anew
+        to the new output. The trace and the hedge counters start over. Other tokens,
+        sessions, latencies and learned bounds are kept.
+        """
+        self.streams
+        for page_id in self.authorization_breaker.reset():
+            self.access_tokens.pop(page_id, None)
+        if self.change_feed_posts is not None:
+            self.change_feed_posts.clear()
+            self.change_feed_posts.update(read_change_feed(self.config["change_feed"]))
+        for stream in self.streams.values():
+            if isinstance(stream, AttachmentMedia):
+                stream.reset()
+        self.tracer.clear()
+        if self.hedger is not None:
+            self.hedger.reset()
+
+    def sync_all(self) -> None:
+        self.load_access_tokens()
+        try:
+            if self.config.get("max_parallel_streams", 1) > 1:
+                self.sync_streams_concurrently(self.config["max_parallel_streams"])
+            else:
+                super().sync_all()
+        finally:
+            self.tracer.write()
+        self.authorization_breaker.report(self.logger)
+        if self.hedger is not None:
+            self.hedger.report(self.logger)
+
+    def sync_streams_concurrently(self, workers: int) -> None:
+        """Sync the selected streams in a pool of worker threads, as ``sync_all`` does one by one.
+
+        Streams are queued round-robin over their endpoints, so the /posts, /insights
+        and /published_posts families progress side by side. ``max_inflight_requests``
+        caps the requests in flight across all streams.
+
+        Messages and the state reads and writes the streams override go through the
+        shared output lock. The SDK's finalizing of partition bookmarks at the end of
+        a stream's sync runs unlocked in its thread; it only changes that stream's own
+        partition states, which no other thread writes.
+        """
+        self._reset_state_progress_markers()
+        self._set_compatible_replication_methods()
+        budget = threading.BoundedSemaphore(self.config.get("max_inflight_requests", workers))
+        families = {}
+        for stream in self.streams.values():
+            stream.request_budget = budget
+            if not stream.selected and not getattr(stream, "has_selected_descendents", False):
+                self.logger.info("Skipping deselected stream '{}'.".format(stream.name))
+                continue
+            if stream.parent_stream_type:
+                self.logger.debug("Child stream '{}' is synced by its parent stream, skipping direct "
+                                  "invocation.".format(type(stream).__name__))
+                continue
+            families.setdefault(stream.path, []).append(stream)
+        queue = [x for streams in itertools.zip_longest(*families.values()) for x in streams if x is not None]
+
+        self.logger.info("Syncing {} streams with {} workers".format(len(queue), workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in as_completed([pool.submit(self.sync_stream, stream) for stream in queue]):
+                future.result()
+
+    @staticmethod
+    def sync_stream(stream: Stream) -> None:
+        stream.sync()
+        stream.finalize_state_progress_markers()
+
     def discover_streams(self) -> List[Stream]:
         streams = []
         # update page access tokens on sync
-        page_ids = self.config['page_ids']
+        page_ids = [x for x in self.config['page_ids'] if in_shard(x, self.shard)]
         self.access_tokens = {}
+        self.activity_bounds = {}
+        self.authorization_breaker = AuthorizationBreaker()
+        self.throttle = ThrottleRegistry()
+        self.change_feed_posts = read_change_feed(self.config["change_feed"]) \
+            if self.config.get("change_feed") else None
+        self.invalid_metrics = InvalidMetricCache(self.config.get("invalid_metric_cache"), API_VERSION)
+        self.output_lock = threading.RLock()
+        self.hedger = None
+        if self.config.get("hedge_percentile"):
+            self.hedger = Hedger(self.config["hedge_percentile"], self.config.get("hedge_budget", DEFAULT_BUDGET),
+                                 self.config.get("max_parallel_streams", 1))
+        self.tracer = Tracer(self.config.get("trace_path"))
+        self.http_adapter = Http2Adapter() if self.config.get("http2") else None
+        if self.http_adapter is not None:
+            # the token calls share the connection with the streams
+            session.mount("https://", self.http_adapter)
+            session.mount("http://", self.http_adapter)
         self.partitions = [{"page_id": x} for x in page_ids]
-        if self.input_catalog:
-            if len(page_ids) > 1:
-                self.get_pages_tokens(page_ids, self.config['access_token'])
-            else:
-                self.access_tokens[page_ids[0]] = self.exchange_token(page_ids[0], self.config['access_token'])
         for stream_class in STREAM_TYPES:
-            stream = stream_class(tap=self)
-            stream.partitions = self.partitions
-            stream.access_tokens = self.access_tokens
-            streams.append(stream)
+            streams.append(stream_class(tap=self))
 
         for insight_stream in INSIGHT_STREAMS:
             stream = insight_stream["class"](tap=self, name=insight_stream["name"])
             stream.tap_stream_id = insight_stream["name"]
             stream.metrics = insight_stream["metrics"]
+            streams.append(stream)
+
+        # run-wide data shared by all streams
+        for stream in streams:
             stream.partitions = self.partitions
             stream.access_tokens = self.access_tokens
-            streams.append(stream)
+            stream.activity_bounds = self.activity_bounds
+            stream.authorization_breaker = self.authorization_breaker
+            stream.throttle = self.throttle
+            stream.change_feed_posts = self.change_feed_posts
+            stream.invalid_metrics = self.invalid_metrics
+            stream.output_lock = self.output_lock
+            stream.hedger = self.hedger
+            stream.tracer = self.tracer
+            stream.http_adapter = self.http_adapter
         return streams
 
+    def link_media_stream(self, streams: List[Stream]) -> None:
+        """Point post_attachments at the attachment_media stream when media are deduplicated.
+
+        The media are only referenced by hash if attachment_media is synced too,
+        otherwise the option is ignored and they stay inline.
+        """
+        media_stream = next((x for x in streams if isinstance(x, AttachmentMedia)), None)
+        if media_stream is None:
+            self.logger.warning("dedup_attachment_media is set but the attachment_media stream is not selected, "
+                                "post_attachments keeps its media and targets inline")
+            return
+        for stream in streams:
+            if isinstance(stream, PostAttachments):
+                stream.media_stream = media_stream
+
     def load_streams(self) -> List[Stream]:
         stream_objects = self.discover_streams()
         if self.input_catalog:
@@ -148,9 +320,44 @@ class TapFacebookPages(Tap):
             stream_objects = [x for x in stream_objects if x.tap_stream_id in selected_streams]
             for obj in stream_objects:
                 self.logger.info("Found stream: " + obj.tap_stream_id)
+        if self.config.get("dedup_attachment_media"):
+            self.link_media_stream(stream_objects)
         return stream_objects
 
 
 # CLI Execution:
 
-cli = TapFacebookPages.cli
+def _pop_option(args: List[str], name: str, is_flag: bool = False) -> Union[str, bool, None]:
+    """Remove a tap specific option from the command line and return its value."""
+    for position, arg in enumerate(args):
+        if arg == name:
+            if is_flag:
+                del args[position]
+                return True
+            if position + 1 < len(args):
+                value = args[position + 1]
+                del args[position:position + 2]
+                return value
+        if not is_flag and arg.startswith(name + "="):
+            del args[position]
+            return arg.split("=", 1)[1]
+    return None
+
+
+def cli():
+    """Run the tap.
+
+    ``--shard INDEX/COUNT`` restricts the sync to the pages hashed into that shard,
+    ``--plan`` prints the requests a sync would issue instead of running it and
+    ``--daemon`` keeps the tap running, syncing on a schedule.
+    """
+    args = sys.argv[1:]
+    shard = _pop_option(args, "--shard")
+    if shard:
+        os.environ[SHARD_ENV] = shard
+    if _pop_option(args, "--plan", is_flag=True):
+        plan_cli(args=args)
+    elif _pop_option(args, "--daemon", is_flag=True):
+        daemon_cli(args=args)
+    else:
+        TapFacebookPages.cli(args=args)
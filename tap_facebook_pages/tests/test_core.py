@@ -1,12 +1,44 @@
 """Tests init and discovery features for tap-facebook-pages."""
+import contextlib
+import gzip
+import copy
+import datetime
+import io
+import json
+import logging
+import re
+import time
+import urllib.parse
 
-from singer_sdk.helpers.util import utc_now
+import pytest
+import requests
+from singer_sdk.helpers._catalog import pop_deselected_record_properties
+from singer_sdk.helpers._singer import Catalog, MetadataMapping, SelectionMask
+from singer_sdk.helpers._state import get_writeable_state_dict
+from singer_sdk.helpers._typing import conform_record_data_types
+from singer_sdk.helpers._util import utc_now
 
+from tap_facebook_pages import streams as tap_streams
+from tap_facebook_pages.batch import BatchWriter
+from tap_facebook_pages.benchmark import generate_rows
+from tap_facebook_pages.changefeed import read_change_feed
+from tap_facebook_pages.conform import get_conformer, parse_timestamp
+from tap_facebook_pages.daemon import OUTPUT_PREFIX, STATE_FILE, Daemon
+from tap_facebook_pages.hedging import MIN_SAMPLES, Hedger
+from tap_facebook_pages.metric_cache import InvalidMetricCache
+from tap_facebook_pages.planner import iter_windows
+from tap_facebook_pages.scale import DAY, DEFAULT_STREAMS, FakeGraph, generate_catalog, generate_config
+from tap_facebook_pages.scheduler import PageScheduler
+from tap_facebook_pages.sharding import in_shard, merge_states
+from tap_facebook_pages.streams import (LARGE_RESPONSE, SCHEMAS_DIR, SLOW_RESPONSE, WINDOW_SIZE, FacebookPagesStream, InvalidMetricError, PageCursor,
+                                        Posts)
+from tap_facebook_pages.throttle import APP_SCOPE, PageThrottledError, parse_rate_limit
 from tap_facebook_pages.tap import TapFacebookPages
 
 SAMPLE_CONFIG = {
-    "start_date": utc_now()
-    # TODO: Initialize minimal tap config and/or register env vars in test harness
+    "access_token": "token",
+    "page_ids": ["1"],
+    "start_date": utc_now().isoformat(),
 }
 
 # TODO: Expand tests as appropriate for your tap.
@@ -19,3 +51,729 @@ def test_catalog_discovery():
     )
     catalog_json = tap.run_discovery()
     assert catalog_json
+
+
+def test_plan_windows_cover_range():
+    """Test planned windows are contiguous and stop at the current time."""
+    now = 1600000000
+    windows = list(iter_windows(now - 3 * WINDOW_SIZE - 5 * 86400, now))
+    assert len(windows) == 4
+    assert all(windows[i][1] == windows[i + 1][0] for i in range(len(windows) - 1))
+    assert windows[-1][1] == now
+
+
+def test_scheduler_interleaves_pages():
+    """Test higher priority pages go first and the others take turns."""
+    scheduler = PageScheduler([{"page_id": x} for x in ("a", "b", "c")], priorities={"c": 1})
+    order = []
+    partition = scheduler.next()
+    while partition:
+        order.append(partition["page_id"])
+        if order.count(partition["page_id"]) < 2:
+            scheduler.requeue(partition, 0)
+        partition = scheduler.next()
+    assert order == ["c", "c", "a", "b", "a", "b"]
+
+
+def test_shards_split_pages_and_merge_states():
+    """Test every page falls in exactly one shard and merged states keep all partitions."""
+    for page_id in ("1", "22", "333", "4444"):
+        assert sum(in_shard(page_id, (x, 3)) for x in (1, 2, 3)) == 1
+    assert in_shard("1", None)
+
+    first = {"bookmarks": {"posts": {"partitions": [
+        {"context": {"page_id": "1"}, "replication_key_value": "2021-01-01"},
+        {"context": {"page_id": "2"}, "replication_key_value": "2021-01-01"},
+    ]}}}
+    second = {"bookmarks": {"posts": {"partitions": [
+        {"context": {"page_id": "2"}, "replication_key_value": "2021-02-01"},
+    ]}, "page": {"replication_key_value": "2021-03-01"}}}
+    merged = merge_states([first, second])
+    partitions = {x["context"]["page_id"]: x["replication_key_value"]
+                  for x in merged["bookmarks"]["posts"]["partitions"]}
+    assert partitions == {"1": "2021-01-01", "2": "2021-02-01"}
+    assert merged["bookmarks"]["page"] == {"replication_key_value": "2021-03-01"}
+
+
+def make_response(body: dict, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 400
+    response._content = json.dumps(body).encode("utf-8")
+    response.headers.update(headers or {})
+    return response
+
+
+def test_parse_rate_limit():
+    """Test throttled responses give their scope and the longest wait of their hints."""
+    usage = json.dumps({"1": [{"call_count": 100, "estimated_time_to_regain_access": 5}]})
+    page_error, app_error = {"error": {"code": 32}}, {"error": {"code": 4}}
+
+    assert parse_rate_limit(make_response(page_error, {"Retry-After": "30"})) == ("page", 30)
+    # estimated_time_to_regain_access is in minutes
+    response = make_response(page_error, {"Retry-After": "30", "x-business-use-case-usage": usage})
+    assert parse_rate_limit(response) == ("page", 300)
+    response = make_response(app_error, {"Retry-After": "600", "x-app-usage": usage})
+    assert parse_rate_limit(response) == (APP_SCOPE, 600)
+    assert parse_rate_limit(make_response({"error": {"code": 100}}, {"Retry-After": "30"})) is None
+
+
+def test_throttled_page_is_not_requested_by_other_streams():
+    """Test a page throttled on one stream raises on the others without sending a request."""
+    tap = TapFacebookPages(config=SAMPLE_CONFIG)
+    posts, insights = tap.streams["posts"], tap.streams["page_insight_engagement"]
+    sent = []
+
+    def send_request(prepared_request):
+        sent.append(prepared_request.url)
+        return make_response({"error": {"code": 32}}, {"Retry-After": "60"})
+
+    for stream in (posts, insights):
+        stream.page_id = "1"
+        stream.send_request = send_request
+    request = requests.Request("GET", "https://graph.facebook.com/1/posts").prepare()
+
+    with pytest.raises(PageThrottledError):
+        posts._request_with_backoff(request)
+    assert len(sent) == 1
+    with pytest.raises(PageThrottledError) as e:
+        insights._request_with_backoff(request)
+    assert len(sent) == 1
+    assert 0 < e.value.wait <= 60
+
+
+def test_change_feed_drops_removed_posts(tmp_path):
+    """Test changed posts are listed once per page and removed posts are left out."""
+    def payload(page_id, **value):
+        return json.dumps({"entry": [{"id": page_id, "changes": [{"field": "feed", "value": value}]}]})
+
+    feed = tmp_path / "feed.jsonl"
+    feed.write_text("\n".join([
+        payload("1", item="status", verb="edited", post_id="1_1"),
+        payload("1", item="comment", verb="add", post_id="1_2"),
+        "not json",
+        payload("1", item="status", verb="remove", post_id="1_1"),
+        payload("2", item="reaction", verb="add", post_id="2_1"),
+        payload("2", item="comment", verb="remove", post_id="2_1"),
+    ]))
+    assert read_change_feed(str(feed)) == {"1": ["1_2"], "2": ["2_1"]}
+
+
+class ProbedStream:
+    """A stream whose probe requests fail whenever they contain one of ``invalid``."""
+    _bisect_metrics = FacebookPagesStream._bisect_metrics
+
+    def __init__(self, invalid):
+        self.invalid = set(invalid)
+        self.probes = 0
+
+    def metrics_accepted(self, partition, metrics, request=None):
+        self.probes += 1
+        return not self.invalid.intersection(metrics)
+
+
+def test_bisect_metrics_finds_invalid_ones(tmp_path):
+    """Test bisecting the metric list finds exactly the rejected metrics and caches them per page."""
+    metrics = ["metric_{}".format(x) for x in range(16)]
+    stream = ProbedStream(["metric_3", "metric_11"])
+    assert stream._bisect_metrics({"page_id": "1"}, metrics) == ["metric_3", "metric_11"]
+    assert stream.probes < len(metrics)
+    assert ProbedStream([])._bisect_metrics({"page_id": "1"}, metrics) == []
+
+    cache = InvalidMetricCache(str(tmp_path / "cache.json"), "v12.0")
+    cache.add(["metric_3"], "1")
+    cache = InvalidMetricCache(str(tmp_path / "cache.json"), "v12.0")
+    assert cache.filter(["metric_3", "metric_4"], "1") == ["metric_4"]
+    assert cache.filter(["metric_3", "metric_4"], "2") == ["metric_3", "metric_4"]
+
+
+class AttachmentPosts(Posts):
+    """The posts stream with the schema passed to it, e.g. one with nested objects."""
+    schema_filepath = None
+
+
+def test_fields_follow_catalog_selection():
+    """Test requests ask for the catalog's selected fields, nested objects projected by sub-field."""
+    catalog = TapFacebookPages(config=SAMPLE_CONFIG).catalog_dict
+    posts = next(x for x in catalog["streams"] if x["tap_stream_id"] == "posts")
+    for entry in posts["metadata"]:
+        if entry["breadcrumb"] in ([], ["properties", "message"]):
+            entry["metadata"]["selected"] = not entry["breadcrumb"]
+    tap = TapFacebookPages(config=SAMPLE_CONFIG, catalog=catalog)
+    fields = tap.streams["posts"].get_fields().split(",")
+    assert "message" not in fields and "page_id" not in fields
+    assert {"id", "created_time", "permalink_url"} <= set(fields)
+
+    string = {"type": ["string", "null"]}
+    schema = {"properties": {
+        "id": string, "created_time": string, "message": string,
+        "attachments": {"type": ["object", "null"], "properties": {"title": string, "url": string, "media": string}},
+    }}
+    metadata = [
+        {"breadcrumb": [], "metadata": {"selected": True}},
+        {"breadcrumb": ["properties", "message"], "metadata": {"selected": False}},
+        {"breadcrumb": ["properties", "attachments", "properties", "title"], "metadata": {"selected": True}},
+        {"breadcrumb": ["properties", "attachments", "properties", "media"], "metadata": {"selected": False}},
+    ]
+    stream = AttachmentPosts(tap=tap, schema=schema)
+    stream.apply_catalog(Catalog.from_dict({"streams": [
+        {"tap_stream_id": "posts", "schema": schema, "metadata": metadata, "key_properties": ["id"],
+         "replication_key": "created_time"},
+    ]}))
+    assert stream.get_fields() == "id,created_time,attachments{title,url}"
+
+
+def test_columnar_schema_follows_catalog_selection():
+    """Test the Arrow schema of an insight stream leaves out the properties deselected in the catalog."""
+    pytest.importorskip("pyarrow")
+    config = dict(SAMPLE_CONFIG, columnar_insights=True)
+    catalog = TapFacebookPages(config=config).catalog_dict
+    for stream in catalog["streams"]:
+        for entry in stream["metadata"]:
+            if entry["breadcrumb"] == ["properties", "description"]:
+                entry["metadata"]["selected"] = False
+    tap = TapFacebookPages(config=config, catalog=catalog)
+    names = tap.streams["page_insight_engagement"].arrow_schema.names
+    assert "description" not in names and "value" in names
+
+
+def test_batch_parts_are_cut_by_size(tmp_path, capsys):
+    """Test STATE messages do not cut parts, which close by size and at the end of the stream."""
+    writer = BatchWriter("page", str(tmp_path / "writer"), max_bytes=1000)
+    for number in range(60):
+        writer.write({"id": str(number), "name": "page {}".format(number)})
+        if number % 5 == 0:
+            writer.flush()
+    writer.close()
+    writer.flush()
+    parts = sorted((tmp_path / "writer").iterdir())
+    assert len(parts) == 2
+    assert len(gzip.open(parts[0]).read()) >= 1000 > len(gzip.open(parts[1]).read())
+    manifests = [json.loads(x)["manifest"] for x in capsys.readouterr().out.splitlines()]
+    assert sum(manifests, []) == [x.as_uri() for x in parts]
+
+    tap = TapFacebookPages(config=dict(SAMPLE_CONFIG, batch_dir=str(tmp_path / "stream")))
+    stream = tap.streams["page"]
+    for number in range(5):
+        stream._write_record_message({"id": str(number), "name": "page {}".format(number)})
+        stream._write_state_message()
+    assert capsys.readouterr().out == ""
+    list(stream.partitions)
+    stream._write_state_message()
+    messages = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert [x["type"] for x in messages] == ["BATCH", "STATE"]
+    assert len(list((tmp_path / "stream").iterdir())) == 1
+
+
+def test_metric_probes_repeat_the_rejected_request():
+    """Test metric probes keep the rejected window and change feed batches are not split for invalid metrics."""
+    tap = TapFacebookPages(config=SAMPLE_CONFIG)
+    stream = tap.streams["post_insight_impressions"]
+    stream.access_tokens = {"1": "token"}
+    stream.invalid_metrics = InvalidMetricCache(None, "v12.0")
+    sent = []
+
+    def request(prepared_request):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(prepared_request.url).query))
+        sent.append(params)
+        if "post_impressions_paid" in re.search(r"metric\((.*?)\)", params["fields"]).group(1).split(","):
+            raise InvalidMetricError("(#100) The value must be a valid insights metric", prepared_request)
+        posts = {x: {"id": x, "created_time": "2021-01-01T00:00:00+0000", "insights": {"data": []}}
+                 for x in params.get("ids", "").split(",") if x}
+        return make_response(posts)
+
+    stream._request_with_backoff = request
+    stream.page_id = "1"
+    params = {"since": 100, "until": 200, "limit": 50, "access_token": "token", "fields": stream.get_fields()}
+    rejected = stream.requests_session.prepare_request(
+        requests.Request("GET", stream.get_url({"page_id": "1"}), params=params))
+    assert stream.isolate_invalid_metrics({"page_id": "1"}, rejected)
+    assert stream.valid_metrics == [x for x in stream.metrics if x != "post_impressions_paid"]
+    assert all(x["since"] == "100" and x["until"] == "200" and x["limit"] == "1" for x in sent)
+
+    stream.invalid_metrics = InvalidMetricCache(None, "v12.0")
+    stream.change_feed_posts = {"1": ["1_{}".format(x) for x in range(8)]}
+    sent.clear()
+    assert list(stream.request_changed_posts({"page_id": "1"})) == []
+    # the probes and the retry ask for all the posts of the batch
+    assert all(len(x["ids"].split(",")) == 8 for x in sent)
+    assert "post_impressions_paid" not in stream.valid_metrics
+
+
+def test_conformer_matches_sdk():
+    """Test the cached conformer gives the records of the SDK's deselection and conforming."""
+    logger = logging.getLogger("tap-facebook-pages")
+    string = {"type": ["string", "null"]}
+    posts_schema = {"properties": {
+        "id": string, "message": string, "is_hidden": {"type": ["boolean", "null"]},
+        "place": {"type": ["object", "null"], "properties": {"name": string, "city": string}},
+    }}
+    posts_mask = MetadataMapping.from_iterable([
+        {"breadcrumb": [], "metadata": {"selected": True}},
+        {"breadcrumb": ["properties", "message"], "metadata": {"selected": False}},
+        {"breadcrumb": ["properties", "place", "properties", "city"], "metadata": {"selected": False}},
+    ]).resolve_selection()
+    posts = [
+        {"id": "1", "message": "hi", "is_hidden": 0, "place": {"name": "Tirana", "city": "Tirana"}, "extra": 1},
+        {"id": "2", "is_hidden": 1, "place": None},
+        {"id": "3", "is_hidden": None, "place": {"city": "Berlin"}},
+    ]
+    with open(SCHEMAS_DIR / "post_insights.json") as f:
+        insights_schema = json.load(f)
+    cases = [
+        ("posts", posts_schema, posts_mask, posts),
+        ("post_insights", insights_schema, SelectionMask(), generate_rows(posts=3, metrics=2, values=2)),
+    ]
+
+    for stream_name, schema, mask, rows in cases:
+        conform = get_conformer(stream_name, schema, logger, mask)
+        expected = []
+        for row in copy.deepcopy(rows):
+            pop_deselected_record_properties(row, schema, mask, logger)
+            expected.append(conform_record_data_types(stream_name, row, schema, logger))
+        assert [conform(x) for x in copy.deepcopy(rows)] == expected
+
+    conform = get_conformer("posts", posts_schema, logger, posts_mask)
+    assert conform(copy.deepcopy(posts[0])) == {"id": "1", "is_hidden": False, "place": {"name": "Tirana"}}
+
+
+def graph_tap(graph: FakeGraph, streams=DEFAULT_STREAMS, state: dict = None, **options) -> TapFacebookPages:
+    """Return a tap syncing the given streams of the fake Graph API."""
+    config = generate_config(graph, **options)
+    catalog = generate_catalog(TapFacebookPages(config=config), list(streams))
+    return TapFacebookPages(config=config, catalog=catalog, state=state or {})
+
+
+def sync_messages(tap: TapFacebookPages) -> list:
+    """Sync the tap and return the written messages."""
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            tap.sync_all()
+    finally:
+        # every line is a whole message
+        tap.messages = [json.loads(x) for x in output.getvalue().splitlines()]
+    return tap.messages
+
+
+def test_concurrent_sync_matches_sequential():
+    """Test streams synced in parallel write whole messages and the state of a sequential sync."""
+    now = int(time.time())
+    graph = FakeGraph(4, 3, since=now - 5 * DAY, now=now).start()
+    try:
+        sequential = sync_messages(graph_tap(graph))
+        concurrent = sync_messages(graph_tap(graph, max_parallel_streams=3))
+    finally:
+        graph.stop()
+
+    def records(messages):
+        return sorted(json.dumps([x["stream"], x["record"]], sort_keys=True)
+                      for x in messages if x["type"] == "RECORD")
+
+    def bookmarks(messages):
+        state = [x["value"] for x in messages if x["type"] == "STATE"][-1]
+        return {name: sorted(json.dumps(x, sort_keys=True) for x in bookmark.get("partitions", []))
+                for name, bookmark in state["bookmarks"].items()}
+
+    assert records(concurrent) == records(sequential)
+    assert bookmarks(concurrent) == bookmarks(sequential)
+    assert set(bookmarks(concurrent)) == set(DEFAULT_STREAMS)
+    # the schema of a stream precedes its records
+    seen = set()
+    for message in concurrent:
+        if message["type"] == "SCHEMA":
+            seen.add(message["stream"])
+        elif message["type"] == "RECORD":
+            assert message["stream"] in seen
+
+
+class Interrupted(BaseException):
+    """Stands in for the tap process being killed."""
+
+
+def test_interrupted_backfill_resumes_from_checkpoint(monkeypatch):
+    """Test a killed backfill resumes from the window of its last checkpoint, not from start_date."""
+    monkeypatch.setattr(tap_streams, "CHECKPOINT_INTERVAL", 0)
+    now = int(time.time())
+    graph = FakeGraph(1, 8, since=now - 400 * DAY, now=now).start()
+    try:
+        tap = graph_tap(graph, ["posts"])
+        posts = tap.streams["posts"]
+        send_request, sent = posts.send_request, []
+
+        def interrupt_third_window(prepared_request):
+            # the earliest activity probes ask for a single post
+            if "limit=1&" not in prepared_request.url:
+                sent.append(prepared_request.url)
+                if len(sent) == 3:
+                    raise Interrupted()
+            return send_request(prepared_request)
+
+        posts.send_request = interrupt_third_window
+        with pytest.raises(Interrupted):
+            sync_messages(tap)
+        state = [x["value"] for x in tap.messages if x["type"] == "STATE"][-1]
+        checkpoint = state["bookmarks"]["posts"]["partitions"][0]["checkpoint"]
+        assert checkpoint["since"] > graph.since
+
+        tap = graph_tap(graph, ["posts"], state)
+        posts = tap.streams["posts"]
+        send_request, resumed = posts.send_request, []
+        posts.send_request = lambda x: resumed.append(x.url) or send_request(x)
+        sync_messages(tap)
+    finally:
+        graph.stop()
+
+    first = urllib.parse.parse_qs(urllib.parse.urlparse(resumed[0]).query)
+    assert int(first["since"][0]) == checkpoint["since"]
+    assert int(first["until"][0]) == checkpoint["until"]
+    state = [x["value"] for x in tap.messages if x["type"] == "STATE"][-1]
+    assert "checkpoint" not in state["bookmarks"]["posts"]["partitions"][0]
+    # the resumed run reads the posts from the checkpoint on
+    created = [x["record"]["created_time"] for x in tap.messages if x["type"] == "RECORD"]
+    assert created and all(parse_timestamp(x).int_timestamp >= checkpoint["since"] for x in created)
+    assert len(created) == len([x for x in range(graph.posts) if graph.post_time(x) >= checkpoint["since"]])
+
+
+def test_probe_skips_empty_windows():
+    """Test the first sync of a page starts at the window of its first post instead of start_date."""
+    now = int(time.time())
+    graph = FakeGraph(1, 4, since=now - 90 * DAY, now=now).start()
+    start = now - 800 * DAY
+    try:
+        tap = graph_tap(graph, ["posts"], start_date=datetime.datetime.utcfromtimestamp(start).isoformat())
+        posts = tap.streams["posts"]
+        send_request, sent = posts.send_request, []
+        posts.send_request = lambda x: sent.append(x.url) or send_request(x)
+        sync_messages(tap)
+    finally:
+        graph.stop()
+
+    params = [urllib.parse.parse_qs(urllib.parse.urlparse(x).query) for x in sent]
+    probes = [x for x in params if x["limit"] == ["1"]]
+    windows = [x for x in params if x["limit"] != ["1"]]
+    first_post = graph.post_time(0)
+    bound = int(windows[0]["since"][0])
+    assert 0 < len(probes) <= 5
+    assert bound == start + (first_post - start) // WINDOW_SIZE * WINDOW_SIZE
+    # the 9 empty windows are skipped at the cost of a few single id requests
+    assert len(windows) <= 3
+    assert len([x for x in tap.messages if x["type"] == "RECORD"]) == graph.posts
+    state = [x["value"] for x in tap.messages if x["type"] == "STATE"][-1]
+    assert state["bookmarks"]["posts"]["partitions"][0]["earliest_activity"] == bound
+
+
+def test_unauthorized_page_is_skipped_by_streams_of_the_scope():
+    """Test a page failing authorization on /posts is skipped by the other posts streams only."""
+    now = int(time.time())
+    graph = FakeGraph(2, 2, since=now - 30 * DAY, now=now).start()
+    denied = graph.page_ids[1]
+    try:
+        tap = graph_tap(graph, ["posts", "post_attachments", "page_insight_engagement"])
+        sent = {}
+        for stream in tap.streams.values():
+            def send_request(prepared_request, stream=stream, send=stream.send_request):
+                page_id = urllib.parse.urlparse(prepared_request.url).path.split("/")[2]
+                sent.setdefault(stream.name, []).append(page_id)
+                if page_id == denied and stream.permission_scope == "posts":
+                    response = make_response({"error": {"code": 200, "message": "Permissions error"}})
+                    response.status_code = 403
+                    return response
+                return send(prepared_request)
+
+            stream.send_request = send_request
+        sync_messages(tap)
+    finally:
+        graph.stop()
+
+    assert denied in sent["posts"]
+    # the breaker is open for the posts scope, the insights scope still syncs the page
+    assert denied not in sent["post_attachments"]
+    assert denied in sent["page_insight_engagement"]
+    records = [x for x in tap.messages if x["type"] == "RECORD"]
+    assert {x["record"]["page_id"] for x in records if x["stream"] == "post_attachments"} == {graph.page_ids[0]}
+    assert tap.authorization_breaker.is_open(denied, "posts")
+    assert not tap.authorization_breaker.is_open(denied, "insights")
+
+    warnings = []
+    tap.authorization_breaker.report(type("Logger", (), {"warning": staticmethod(warnings.append)}))
+    assert warnings[1].startswith("  page {} scope 'posts': first failed in posts".format(denied))
+    assert warnings[1].endswith("skipped 1 more stream partition(s)")
+
+
+def test_next_page_token_follows_cursors_and_windows():
+    """Test the cursor stays in the window while the API pages through it, then moves to the next window."""
+    tap = TapFacebookPages(config=SAMPLE_CONFIG)
+    posts = tap.streams["posts"]
+    posts.page_id = "1"
+    since = int(time.time()) - 400 * DAY
+    until = since + WINDOW_SIZE
+
+    def page(body: dict, token: PageCursor = None) -> requests.Response:
+        response = make_response(body)
+        response.status_code = 200
+        params = {"since": since, "until": until, "after": token and token.after}
+        response.request = requests.Request("GET", "https://graph.facebook.com/1/posts", params=params).prepare()
+        return response
+
+    paged = {"data": [{"id": "1_1"}], "paging": {"cursors": {"after": "abc"}, "next": "https://graph.facebook.com/next"}}
+    token = posts.get_next_page_token(page(paged))
+    assert token == PageCursor(since, until, "abc")
+    # the last page of the window has no next link, an empty window neither
+    last = {"data": [{"id": "1_2"}], "paging": {"cursors": {"before": "abc"}}}
+    assert posts.get_next_page_token(page(last, token), token) == PageCursor(until, until + WINDOW_SIZE)
+    assert posts.get_next_page_token(page({"data": []})) == PageCursor(until, until + WINDOW_SIZE)
+    # time based paging moves the window
+    moved = {"data": [{"id": "1_3"}], "paging": {"next": "https://graph.facebook.com/1/posts?since={}&until={}".format(
+        until, until + DAY)}}
+    assert posts.get_next_page_token(page(moved)) == PageCursor(until, until + DAY)
+    # the window reaching the present is the last one
+    since, until = int(time.time()) - 10 * DAY, int(time.time())
+    assert posts.get_next_page_token(page({"data": []})) is None
+
+
+def test_page_insight_periods():
+    """Test a single configured period is requested from the API and several ones are filtered."""
+    config = dict(SAMPLE_CONFIG, periods=["day", "week"], stream_periods={"page_insight_engagement": ["day"]})
+    tap = TapFacebookPages(config=config)
+    engagement, feedback = tap.streams["page_insight_engagement"], tap.streams["page_insight_feedback"]
+    rows = [{"name": "page_engaged_users", "period": x, "title": "Engaged", "id": "1/insights/page_engaged_users/" + x,
+             "values": [{"value": 1, "end_time": "2021-01-02T08:00:00+0000"}]} for x in ("day", "week", "days_28")]
+
+    assert engagement.get_metric_params(["page_engaged_users"]) == {"metric": "page_engaged_users", "period": "day"}
+    assert feedback.get_metric_params(["page_engaged_users"]) == {"metric": "page_engaged_users"}
+    assert [x["period"] for x in feedback.parse_rows(copy.deepcopy(rows))] == ["day", "week"]
+    assert [x["period"] for x in engagement.parse_rows(copy.deepcopy(rows))] == ["day"]
+    # without periods every period the API returns is synced
+    tap = TapFacebookPages(config=SAMPLE_CONFIG)
+    assert "period" not in tap.streams["page_insight_engagement"].get_metric_params(["page_engaged_users"])
+    assert len(list(tap.streams["page_insight_engagement"].parse_rows(copy.deepcopy(rows)))) == 3
+
+
+def test_partition_state_index_matches_sdk_lookup():
+    """Test the indexed partition states are the ones the SDK finds by scanning the partitions list."""
+    partitions = [{"context": {"page_id": str(x)}, "replication_key_value": str(x)} for x in range(100)]
+    state = {"bookmarks": {"posts": {"partitions": partitions}}}
+    tap = TapFacebookPages(config=SAMPLE_CONFIG, state=state)
+    posts = tap.streams["posts"]
+
+    for page_id in ("0", "42", "99"):
+        expected = get_writeable_state_dict(posts.tap_state, "posts", {"page_id": page_id})
+        assert posts.get_context_state({"page_id": page_id}) is expected
+    # unknown pages get a new partition state once
+    new = posts.get_context_state({"page_id": "new"})
+    assert posts.get_context_state({"page_id": "new"}) is new
+    assert get_writeable_state_dict(posts.tap_state, "posts", {"page_id": "new"}) is new
+    assert len(posts.stream_state["partitions"]) == 101
+    # the index follows a replaced partitions list
+    posts.stream_state["partitions"] = [{"context": {"page_id": "42"}, "replication_key_value": "replaced"}]
+    assert posts.get_context_state({"page_id": "42"})["replication_key_value"] == "replaced"
+
+
+class SlowSession:
+    """Answer the n-th request sent after the n-th of the given latencies."""
+
+    def __init__(self, latencies: list):
+        self.latencies = latencies
+        self.sent = 0
+
+    def send(self, prepared_request: requests.PreparedRequest) -> int:
+        self.sent += 1
+        time.sleep(self.latencies[self.sent - 1])
+        return self.sent
+
+
+def test_hedger_duplicates_late_requests_within_budget():
+    """Test a late request is answered by its hedge and the budget bounds the hedges."""
+    hedger = Hedger(90, budget=0.05)
+    session = SlowSession([0.01] * MIN_SAMPLES + [1, 0.01, 0.3])
+    request = requests.Request("GET", "https://graph.facebook.com/1/posts").prepare()
+    for _ in range(MIN_SAMPLES):
+        hedger.send("posts", session, request)
+    assert hedger.hedges == 0
+
+    started = time.perf_counter()
+    # the hedge, sent second, answers first
+    assert hedger.send("posts", session, request) == MIN_SAMPLES + 2
+    assert time.perf_counter() - started < 0.5
+    assert (hedger.hedges, hedger.wins) == (1, 1)
+    # the budget of 0.05 hedges per request is spent
+    assert hedger.send("posts", session, request) == MIN_SAMPLES + 3
+    assert (hedger.requests, hedger.hedges, hedger.wins) == (MIN_SAMPLES + 2, 1, 1)
+
+    hedger.reset()
+    assert (hedger.requests, hedger.hedges, hedger.wins) == (0, 0, 0)
+    assert hedger.delay("posts") is not None
+
+
+def test_limit_adapts_to_responses_within_bounds():
+    """Test slow or large pages halve the page size of a partition and fast full ones grow it."""
+    tap = TapFacebookPages(config=dict(SAMPLE_CONFIG, min_limit=20, max_limit=200))
+    posts = tap.streams["posts"]
+    partition = {"page_id": "1"}
+
+    def tune(seconds: float, size: int, rows: int) -> int:
+        response = make_response({})
+        response._content = b"x" * size
+        response.elapsed = datetime.timedelta(seconds=seconds)
+        posts.tune_limit(partition, response, rows, posts.get_limit(partition))
+        return posts.get_limit(partition)
+
+    assert posts.get_limit(partition) == 100
+    assert tune(SLOW_RESPONSE + 1, 1000, 100) == 50
+    assert tune(1, LARGE_RESPONSE + 1, 50) == 25
+    assert tune(1, LARGE_RESPONSE + 1, 25) == 20
+    # a page that is not full says nothing about larger pages
+    assert tune(0.1, 1000, 10) == 20
+    assert [tune(0.1, 1000, 200) for _ in range(6)] == [30, 45, 67, 100, 150, 200]
+    # the learned size is kept in the partition state for the next run
+    assert posts.get_stream_or_partition_state(partition)["limit"] == 200
+    assert posts.get_url_params(partition)["limit"] == 200
+
+
+def test_daemon_cycles_sync_incrementally_into_new_files(tmp_path):
+    """Test every daemon cycle writes a new output file, continues from the state and rotates the files."""
+    now = int(time.time())
+    graph = FakeGraph(2, 6, since=now - 60 * DAY, now=now).start()
+    try:
+        tap = graph_tap(graph, ["posts"])
+        daemon = Daemon(tap, str(tmp_path), interval=0, keep=2)
+        outputs = [daemon.run_cycle() for _ in range(3)]
+    finally:
+        graph.stop()
+
+    assert len(set(outputs)) == 3
+    assert sorted(tmp_path.glob(OUTPUT_PREFIX + "*")) == sorted(outputs[1:])
+    with open(tmp_path / STATE_FILE) as f:
+        assert json.load(f) == tap.state
+
+    def records(path):
+        with open(path) as f:
+            return [x["record"] for x in map(json.loads, f) if x["type"] == "RECORD"]
+
+    # the later cycles start from the bookmarks of the previous one
+    assert len(records(outputs[2])) < 2 * graph.posts
+    assert records(outputs[1]) == records(outputs[2])
+
+
+def test_trace_has_a_span_per_request(tmp_path):
+    """Test config['trace_path'] writes a Chrome trace with the requests and parsing of the sync."""
+    trace_path = tmp_path / "trace.json"
+    now = int(time.time())
+    graph = FakeGraph(2, 3, since=now - 30 * DAY, now=now).start()
+    try:
+        tap = graph_tap(graph, ["posts"], trace_path=str(trace_path))
+        posts = tap.streams["posts"]
+        send_request, sent = posts.send_request, []
+        posts.send_request = lambda x: sent.append(x.url) or send_request(x)
+        sync_messages(tap)
+    finally:
+        graph.stop()
+
+    with open(trace_path) as f:
+        events = json.load(f)["traceEvents"]
+    request_spans = [x for x in events if x["name"] == "request"]
+    assert len(request_spans) == len(sent)
+    assert {x["args"]["page_id"] for x in request_spans} == set(graph.page_ids)
+    assert all(x["ph"] == "X" and x["dur"] >= 0 and x["args"]["status"] == 200 for x in request_spans)
+    parsed = [x for x in events if x["name"] == "parse"]
+    assert sum(x["args"]["rows"] for x in parsed) == 2 * graph.posts
+    threads = {x["tid"] for x in events if x["ph"] == "X"}
+    assert threads <= {x["tid"] for x in events if x["name"] == "thread_name"}
+
+    # a repeated sync writes only its own spans
+    tap.tracer.clear()
+    tap.tracer.write()
+    with open(trace_path) as f:
+        assert json.load(f)["traceEvents"] == []
+
+
+def test_http2_adapter_serves_the_sync(monkeypatch):
+    """Test config['http2'] sends every request of the streams through the httpx adapter."""
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    # the page token calls share the module's session with the adapter
+    monkeypatch.setattr("tap_facebook_pages.tap.session", requests.Session())
+    now = int(time.time())
+    graph = FakeGraph(2, 3, since=now - 30 * DAY, now=now).start()
+    try:
+        expected = sync_messages(graph_tap(graph, ["page", "posts"]))
+        tap = graph_tap(graph, ["page", "posts"], http2=True)
+        # the streams are discovered on first use, exchanging the page tokens over the adapter
+        assert tap.streams["posts"].http_adapter is tap.http_adapter
+        adapter, sent = tap.http_adapter, []
+        send = adapter.send
+        adapter.send = lambda request, **kwargs: sent.append(request.url) or send(request, **kwargs)
+        requests_before = graph.requests
+        messages = sync_messages(tap)
+        adapter.close()
+    finally:
+        graph.stop()
+
+    assert [x["record"] for x in messages if x["type"] == "RECORD"] == \
+        [x["record"] for x in expected if x["type"] == "RECORD"]
+    assert len(sent) == graph.requests - requests_before
+
+
+def test_attachment_media_are_emitted_once_per_run():
+    """Test deduplicated attachments reference media and targets emitted once per run by attachment_media."""
+    now = int(time.time())
+    graph = FakeGraph(2, 3, since=now - 30 * DAY, now=now).start()
+    try:
+        tap = graph_tap(graph, ["post_attachments", "attachment_media"], dedup_attachment_media=True)
+        runs = [sync_messages(tap)]
+        # the incremental run emits the media of its attachments to its own output again
+        tap.reset_run()
+        runs.append(sync_messages(tap))
+    finally:
+        graph.stop()
+
+    counts = []
+    for messages in runs:
+        records = [x for x in messages if x["type"] == "RECORD"]
+        attachments = [x["record"] for x in records if x["stream"] == "post_attachments"]
+        media = [x["record"] for x in records if x["stream"] == "attachment_media"]
+        counts.append(len(attachments))
+        assert not any("media" in x or "target" in x for x in attachments)
+        # every post shares the image, the posts of the same index share the target
+        targets = {x["post_id"].split("_")[1] for x in attachments}
+        assert sorted(x["kind"] for x in media) == ["media"] + ["target"] * len(targets)
+        hashes = {x["hash"] for x in media}
+        assert len(hashes) == len(media)
+        assert {x["media_hash"] for x in attachments} | {x["target_hash"] for x in attachments} == hashes
+        # the schema precedes the media, post_attachments syncs before attachment_media announces it
+        assert [x["type"] for x in messages if x.get("stream") == "attachment_media"][0] == "SCHEMA"
+    assert counts[0] == 2 * graph.posts
+    assert 0 < counts[1] < counts[0]
+
+
+def test_snapshot_rows_of_lifetime_totals():
+    """Test every snapshot sync adds a lifetime row per metric of the posts in the lookback period."""
+    now = int(time.time())
+    graph = FakeGraph(1, 6, since=now - 60 * DAY, now=now).start()
+    try:
+        tap = graph_tap(graph, ["post_insight_impressions"], snapshot_streams=["post_insight_impressions"],
+                        snapshot_lookback_days=28)
+        stream = tap.streams["post_insight_impressions"]
+        send_request, sent = stream.send_request, []
+        stream.send_request = lambda x: sent.append(x.url) or send_request(x)
+        runs = [sync_messages(tap)]
+        tap.reset_run()
+        runs.append(sync_messages(tap))
+    finally:
+        graph.stop()
+
+    schema = next(x for x in runs[0] if x["type"] == "SCHEMA")
+    assert schema["key_properties"] == ["id", "snapshot_time"]
+    assert all("period(lifetime)" in urllib.parse.unquote(x) for x in sent if "limit=1&" not in x)
+    recent = {"{}_{}".format(graph.page_ids[0], x) for x in range(graph.posts) if graph.post_time(x) >= now - 28 * DAY}
+    snapshot_times = []
+    for messages, posts in zip(runs, [graph.posts, len(recent)]):
+        records = [x["record"] for x in messages if x["type"] == "RECORD"]
+        assert len(records) == posts * len(stream.metrics)
+        assert {x["period"] for x in records} == {"lifetime"}
+        assert len({(x["post_id"], x["name"]) for x in records}) == len(records)
+        snapshot_times.append({x["snapshot_time"] for x in records})
+    # the second run reads the recent posts again, whatever the bookmark
+    assert {x["record"]["post_id"] for x in runs[1] if x["type"] == "RECORD"} == recent
+    assert len(snapshot_times[0]) == len(snapshot_times[1]) == 1
+    assert snapshot_times[0] != snapshot_times[1]
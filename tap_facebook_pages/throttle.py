@@ -0,0 +1,88 @@
+"""Rate limit hints of the Graph API and the run-wide record of throttled pages."""
+import json
+import threading
+import time as t
+from typing import Optional, Tuple
+
+import requests
+
+APP_SCOPE = "app"
+DEFAULT_WAIT = 60  # seconds, when a throttled response carries no hint
+
+# error codes of throttling applied to the whole app or user token
+APP_RATE_LIMIT_CODES = (4, 17, 613)
+# error codes of throttling applied to a single page
+PAGE_RATE_LIMIT_CODES = (32, 80001)
+
+USAGE_HEADERS = ("x-page-usage", "x-app-usage", "x-business-use-case-usage")
+
+
+class PageThrottledError(Exception):
+    def __init__(self, page_id: str, wait: float):
+        Exception.__init__(self, "Page {} is throttled for {} seconds".format(page_id, int(wait)))
+        self.page_id = page_id
+        self.wait = wait
+
+
+def _usage_regain_minutes(value) -> float:
+    """Return the largest estimated_time_to_regain_access (minutes) found in a usage header value."""
+    if isinstance(value, dict):
+        minutes = value.get("estimated_time_to_regain_access") or 0
+        return max([minutes] + [_usage_regain_minutes(x) for x in value.values() if isinstance(x, (dict, list))])
+    if isinstance(value, list):
+        return max([0] + [_usage_regain_minutes(x) for x in value])
+    return 0
+
+
+def parse_rate_limit(response: requests.Response) -> Optional[Tuple[str, float]]:
+    """Return (scope, seconds to wait) for a throttled response, None otherwise.
+
+    The wait is taken from the ``Retry-After`` header or the largest
+    ``estimated_time_to_regain_access`` of the usage headers.
+    """
+    try:
+        code = response.json().get("error", {}).get("code")
+    except ValueError:
+        return None
+    if code in PAGE_RATE_LIMIT_CODES:
+        scope = "page"
+    elif code in APP_RATE_LIMIT_CODES:
+        scope = APP_SCOPE
+    else:
+        return None
+
+    wait = 0.0
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        wait = float(retry_after)
+    for header in USAGE_HEADERS:
+        if header in response.headers:
+            try:
+                wait = max(wait, 60 * _usage_regain_minutes(json.loads(response.headers[header])))
+            except ValueError:
+                continue
+    return scope, wait or DEFAULT_WAIT
+
+
+class ThrottleRegistry:
+    """Remember until when the app or single pages are throttled."""
+
+    def __init__(self):
+        self._blocked_until = {}
+        self._lock = threading.Lock()
+
+    def block(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until[key] = max(self._blocked_until.get(key, 0), t.time() + seconds)
+
+    def blocked_until(self, key: str) -> float:
+        return self._blocked_until.get(key, 0)
+
+    def is_blocked(self, key: str) -> bool:
+        return self.blocked_until(key) > t.time()
+
+    def wait(self, key: str) -> None:
+        """Sleep until the key is no longer throttled."""
+        remaining = self.blocked_until(key) - t.time()
+        if remaining > 0:
+            t.sleep(remaining)
@@ -0,0 +1,63 @@
+"""Request timeline traces in the Chrome trace event format, viewable in Perfetto or chrome://tracing."""
+import contextlib
+import json
+import os
+import threading
+import time as t
+from typing import Optional
+
+
+class Tracer:
+    """Record spans of the sync and write them as a Chrome trace JSON file.
+
+    Without a ``path`` the tracer is disabled and its spans cost next to nothing.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.enabled = bool(path)
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._origin = t.perf_counter()
+        self._pid = os.getpid()
+
+    def add(self, name: str, category: str, started: float, duration: float, **args) -> None:
+        """Add a span that started at ``started`` (a ``time.perf_counter`` value) and lasted ``duration`` seconds."""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": self._pid, "tid": thread.ident,
+            "ts": round((started - self._origin) * 1e6, 1), "dur": round(duration * 1e6, 1), "args": args,
+        }
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        """Record the time spent in the block, the yielded dict takes args known only at its end."""
+        started = t.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, category, started, t.perf_counter() - started, **args)
+
+    def clear(self) -> None:
+        """Drop the recorded spans, a repeated sync writes only its own."""
+        with self._lock:
+            self._events = []
+            self._threads = {}
+            self._origin = t.perf_counter()
+
+    def write(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            events = [
+                {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.items()
+            ] + self._events
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
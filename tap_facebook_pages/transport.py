@@ -0,0 +1,53 @@
+"""Optional HTTP/2 transport for the requests sessions of the tap, backed by httpx."""
+import datetime
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class Http2Adapter(BaseAdapter):
+    """A requests transport adapter sending over one multiplexed httpx HTTP/2 client.
+
+    Mounted on a ``requests.Session`` it serves every request of the session, so all
+    concurrent requests to graph.facebook.com share a single connection instead of
+    opening one TCP and TLS connection each. Needs ``pip install httpx[http2]``.
+    """
+
+    def __init__(self, timeout: float = 300):
+        super().__init__()
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("The http2 option needs httpx, install it with `pip install httpx[http2]`")
+        self._httpx = httpx
+        self._client = httpx.Client(http2=True, timeout=timeout)
+
+    def send(self, request: requests.PreparedRequest, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None) -> requests.Response:
+        httpx = self._httpx
+        started = datetime.datetime.now()
+        try:
+            # the request timeout is set on the client, requests' per call timeout tuples do not map onto it
+            result = self._client.request(request.method, request.url, headers=dict(request.headers),
+                                          content=request.body)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.headers = CaseInsensitiveDict(result.headers.multi_items())
+        response._content = result.content
+        response._content_consumed = True
+        response.encoding = result.encoding
+        response.reason = result.reason_phrase
+        response.url = str(result.url)
+        response.request = request
+        response.elapsed = datetime.datetime.now() - started
+        response.connection = self
+        return response
+
+    def close(self) -> None:
+        self._client.close()